@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""Benchmark reading repository metadata while adding repos to Mr. Repo.
+
+Creates COUNT repositories with an `origin` remote and compares reading their
+remote URLs through GitPython with reading them through mr_repo.gitmeta, then
+times a full `init` of a Mr. Repo repository over them. For each it reports
+the wall clock time and the number of git processes spawned.
+
+    python benchmarks/bench_metadata.py [COUNT]
+"""
+# Author: Ryan McGowan
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mr_repo import gitmeta, metrics
+from mr_repo.workspace import Workspace
+import git
+import shutil
+import subprocess
+import tempfile
+import time
+
+
+def make_repos(base, count):
+    paths = []
+    for index in range(count):
+        path = os.path.join(base, 'repo_%d' % index)
+        subprocess.check_call(['git', 'init', '-q', path])
+        subprocess.check_call(['git', 'remote', 'add', 'origin',
+            'git://example.com/repo_%d' % index], cwd=path)
+        paths.append(path)
+    return paths
+
+
+def measure(label, func):
+    counters = metrics.Counters()
+    start = time.time()
+    with metrics.counting_git_subprocesses(counters):
+        func()
+    duration = time.time() - start
+    print("%-28s %8.3fs %8d git processes" % (label, duration,
+        counters.values['git_subprocesses']))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    base = tempfile.mkdtemp(prefix='mrrepobench')
+    try:
+        paths = make_repos(base, count)
+        print("%d repositories" % count)
+        measure("GitPython remote().url",
+                lambda: [git.Repo(path).remote().url for path in paths])
+        measure("gitmeta remote_url()",
+                lambda: [gitmeta.RepoMetadata(path).remote_url() for path in
+                    paths])
+        measure("Workspace.init()",
+                lambda: Workspace(base, create=True).init())
+    finally:
+        shutil.rmtree(base)
+
+
+if __name__ == '__main__':
+    main()
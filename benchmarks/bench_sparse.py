@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""Benchmark `get` with and without a sparse checkout profile.
+
+Creates a repository with DIRS directories of FILES files each and gets it
+into a Mr. Repo repository twice: once in full and once with a sparse profile
+selecting a single directory. Reports the files written and the time taken.
+
+    python benchmarks/bench_sparse.py [DIRS [FILES]]
+"""
+# Author: Ryan McGowan
+
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mr_repo.workspace import Workspace
+import shutil
+import subprocess
+import tempfile
+import time
+
+
+def make_source(path, dirs, files):
+    subprocess.check_call(['git', 'init', '-q', path])
+    for directory in range(dirs):
+        dir_path = os.path.join(path, 'dir_%d' % directory)
+        os.mkdir(dir_path)
+        for index in range(files):
+            with open(os.path.join(dir_path, 'file_%d' % index), 'w') as \
+                    source_file:
+                source_file.write('%d/%d\n' % (directory, index))
+    subprocess.check_call(['git', 'add', '-A'], cwd=path)
+    # No automatic gc: it would run in the background during the benchmark
+    subprocess.check_call(['git', '-c', 'gc.auto=0', '-c', 'user.name=bench',
+        '-c', 'user.email=bench@example.com', 'commit', '-q', '-m', 'Files'],
+        cwd=path)
+
+
+def count_files(path):
+    count = 0
+    for base, directories, filenames in os.walk(path):
+        if '.git' in directories:
+            directories.remove('.git')
+        count += len(filenames)
+    return count
+
+
+def main():
+    dirs = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    files = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    base = tempfile.mkdtemp(prefix='mrrepobench')
+    try:
+        source = os.path.join(base, 'source')
+        make_source(source, dirs, files)
+        workspace_path = os.path.join(base, 'workspace')
+        os.mkdir(workspace_path)
+        workspace = Workspace(workspace_path, create=True)
+        workspace.init(clean=True)
+        workspace.config['repos']['full'] = {'type': 'Git',
+                'remote': source, 'path': 'full'}
+        workspace.config['repos']['sparse'] = {'type': 'Git',
+                'remote': source, 'path': 'sparse', 'sparse': ['/dir_0/']}
+        workspace.save()
+
+        print("%d files in %d directories" % (dirs * files, dirs))
+        for name in ['full', 'sparse']:
+            start = time.time()
+            result = workspace.get([name])[0]
+            duration = time.time() - start
+            if not result.ok:
+                print(result.message)
+                continue
+            print("%-8s %8d files written %8.3fs" % (name, count_files(
+                os.path.join(workspace_path, name)), duration))
+    finally:
+        shutil.rmtree(base)
+
+
+if __name__ == '__main__':
+    main()
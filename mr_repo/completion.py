@@ -0,0 +1,241 @@
+# Author: Ryan McGowan
+"""Shell completion for Mr. Repo.
+
+Completing repository names must not start Python, so every write of the
+tracking files also writes a plain text index (`.mr_repo_complete`) with one
+`<state> <name>` line per controlled repository, where state is `available` or
+`unavailable`. The bash and zsh scripts generated here read that index with
+shell builtins only.
+"""
+
+import os
+import tempfile
+
+SHELLS = ['bash', 'zsh']
+
+# What the positional arguments of each command complete to: a set of
+# repository names from the index (`available`, `unavailable` or `all`),
+# `directories`, `commands` or a list of words.
+COMPLETIONS = {
+    'add': 'directories',
+    'rm': 'all',
+    'get': 'unavailable',
+    'unget': 'available',
+    'gc': 'available',
+    'freeze': 'available',
+    'restore': 'all',
+    'sparse': 'all',
+    'stats': 'commands',
+    'completion': SHELLS,
+}
+
+# Commands whose completion above only applies to their first positional
+# argument (e.g. the profile of `sparse <name> <profile>` is not a repository)
+FIRST_ARGUMENT_ONLY = ['sparse']
+
+# Options whose value is a directory or a file rather than another word
+DIRECTORY_OPTIONS = ['-d', '--dir']
+FILE_OPTIONS = ['--prometheus-textfile']
+
+
+def write_index(path, names, available):
+    """Atomically write the completion index for the controlled repository
+    `names` of which `available` are currently available."""
+    lines = ["%s %s\n" % ('available' if name in available else
+        'unavailable', name) for name in sorted(names)]
+    # Every writer gets its own temporary file as `completion` rewrites the
+    # index without holding the tracking files' lock
+    (handle, temp_path) = tempfile.mkstemp(suffix='.tmp',
+            prefix=os.path.basename(path) + '.',
+            dir=os.path.dirname(path) or '.')
+    with os.fdopen(handle, 'w') as index_file:
+        index_file.writelines(lines)
+    os.chmod(temp_path, 0o644)
+    os.rename(temp_path, path)
+
+
+_BASH = '''\
+# Mr. Repo bash completion, generated by `mr_repo completion bash`.
+# Enable with: source <(mr_repo completion bash)
+
+_mr_repo_names() {
+    # Add the repos of state $1 (or all) in the index to $words
+    local dir=. state name i
+    for ((i = 1; i < COMP_CWORD; i++)); do
+        case "${COMP_WORDS[i]}" in
+            -d|--dir) dir="${COMP_WORDS[i+1]}" ;;
+        esac
+    done
+    [ -r "$dir/%(index)s" ] || return 0
+    while read -r state name; do
+        if [ "$1" = all ] || [ "$1" = "$state" ]; then
+            words="$words $name"
+        fi
+    done < "$dir/%(index)s"
+}
+
+_mr_repo() {
+    local cur="${COMP_WORDS[COMP_CWORD]}" command="" position=0 words="" i
+    # Find the command and how many of its positional arguments precede $cur
+    for ((i = 1; i < COMP_CWORD; i++)); do
+        case "${COMP_WORDS[i]}" in
+            %(value_options)s) ((i++)) ;;
+            -*) ;;
+            *)
+                if [ -z "$command" ]; then
+                    command="${COMP_WORDS[i]}"
+                else
+                    position=$((position + 1))
+                fi ;;
+        esac
+    done
+    case "${COMP_WORDS[COMP_CWORD-1]}" in
+        %(directory_options)s) COMPREPLY=($(compgen -d -- "$cur")); return ;;
+        %(file_options)s) COMPREPLY=($(compgen -f -- "$cur")); return ;;
+    esac
+    if [ -z "$command" ]; then
+        if [[ "$cur" == -* ]]; then
+            words="%(global_options)s"
+        else
+            words="%(commands)s"
+        fi
+    elif [[ "$cur" == -* ]]; then
+        case "$command" in
+%(bash_options)s
+        esac
+    else
+        case "$command" in
+%(bash_arguments)s
+        esac
+    fi
+    COMPREPLY=($(compgen -W "$words" -- "$cur"))
+}
+
+complete -F _mr_repo mr_repo
+'''
+
+_ZSH = '''\
+#compdef mr_repo
+# Mr. Repo zsh completion, generated by `mr_repo completion zsh`.
+# Enable with: source <(mr_repo completion zsh) (after compinit)
+
+_mr_repo_names() {
+    # Complete the repos of state $1 (or all) in the index
+    local dir=. state name i
+    local -a names
+    for ((i = 2; i < CURRENT; i++)); do
+        case "$words[i]" in
+            -d|--dir) dir="$words[i+1]" ;;
+        esac
+    done
+    [[ -r "$dir/%(index)s" ]] || return 1
+    while read -r state name; do
+        if [[ "$1" == all || "$1" == "$state" ]]; then
+            names+=("$name")
+        fi
+    done < "$dir/%(index)s"
+    compadd -a names
+}
+
+_mr_repo() {
+    local command="" position=0 i
+    # Find the command and how many of its positional arguments precede the
+    # current word
+    for ((i = 2; i < CURRENT; i++)); do
+        case "$words[i]" in
+            %(value_options)s) ((i++)) ;;
+            -*) ;;
+            *)
+                if [[ -z "$command" ]]; then
+                    command="$words[i]"
+                else
+                    position=$((position + 1))
+                fi ;;
+        esac
+    done
+    case "$words[CURRENT-1]" in
+        %(directory_options)s) _files -/; return ;;
+        %(file_options)s) _files; return ;;
+    esac
+    if [[ -z "$command" ]]; then
+        if [[ "$PREFIX" == -* ]]; then
+            compadd -- %(global_options)s
+        else
+            compadd -- %(commands)s
+        fi
+    elif [[ "$PREFIX" == -* ]]; then
+        case "$command" in
+%(zsh_options)s
+        esac
+    else
+        case "$command" in
+%(zsh_arguments)s
+        esac
+    fi
+}
+
+compdef _mr_repo mr_repo
+'''
+
+
+def _bash_argument(completion, first_only=False):
+    if completion == 'directories':
+        action = 'COMPREPLY=($(compgen -d -- "$cur")); return'
+    elif completion in ['available', 'unavailable', 'all']:
+        action = '_mr_repo_names %s' % completion
+    else:
+        action = 'words="%s"' % ' '.join(completion)
+    if first_only:
+        return 'if [ "$position" -eq 0 ]; then %s; fi' % action
+    return action
+
+
+def _zsh_argument(completion, first_only=False):
+    if completion == 'directories':
+        action = '_files -/'
+    elif completion in ['available', 'unavailable', 'all']:
+        action = '_mr_repo_names %s' % completion
+    else:
+        action = 'compadd -- %s' % ' '.join(completion)
+    if first_only:
+        return 'if [[ "$position" -eq 0 ]]; then %s; fi' % action
+    return action
+
+
+def script(shell, global_options, commands, index_name):
+    """Return the completion script for `shell`.
+
+    `global_options` is the list of options accepted before a command and
+    `commands` maps every command to the list of its options."""
+    command_names = sorted(commands.keys())
+    arguments = {}
+    for command in command_names:
+        completion = COMPLETIONS.get(command)
+        if completion == 'commands':
+            completion = command_names
+        if completion:
+            arguments[command] = completion
+
+    cases = {'bash_options': [], 'bash_arguments': [], 'zsh_options': [],
+            'zsh_arguments': []}
+    for command in command_names:
+        options = ' '.join(sorted(commands[command]))
+        cases['bash_options'].append('            %s) words="%s" ;;' % (
+            command, options))
+        cases['zsh_options'].append('            %s) compadd -- %s ;;' % (
+            command, options))
+        if command in arguments:
+            first_only = command in FIRST_ARGUMENT_ONLY
+            cases['bash_arguments'].append('            %s) %s ;;' % (
+                command, _bash_argument(arguments[command], first_only)))
+            cases['zsh_arguments'].append('            %s) %s ;;' % (
+                command, _zsh_argument(arguments[command], first_only)))
+
+    values = dict([(key, '\n'.join(lines)) for key, lines in cases.items()])
+    values.update({'index': index_name,
+        'value_options': '|'.join(DIRECTORY_OPTIONS + FILE_OPTIONS),
+        'directory_options': '|'.join(DIRECTORY_OPTIONS),
+        'file_options': '|'.join(FILE_OPTIONS),
+        'global_options': ' '.join(sorted(global_options)),
+        'commands': ' '.join(command_names)})
+    return (_BASH if shell == 'bash' else _ZSH) % values
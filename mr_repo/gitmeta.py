@@ -0,0 +1,208 @@
+# Author: Ryan McGowan
+"""Read Git repository metadata without running git.
+
+Only what Mr. Repo needs is supported: locating the git directory (including
+`.git` files as used by worktrees and submodules), reading remotes from the
+config and resolving HEAD through loose and packed refs. Anything unusual
+raises UnsupportedLayout so callers can fall back to GitPython.
+"""
+
+import os
+import re
+
+
+class UnsupportedLayout(Exception):
+    """Raised when a repository cannot be read without git."""
+
+
+_SECTION = re.compile(r'^\s*\[\s*([-.\w]+)\s*(?:"((?:[^"\\]|\\.)*)")?\s*\]'
+        r'(.*)$')
+_ESCAPES = {'n': '\n', 't': '\t', 'b': '\b', '"': '"', '\\': '\\'}
+
+
+def _read(path):
+    with open(path) as git_file:
+        return git_file.read()
+
+
+def find_git_dir(path):
+    """Return the git directory of the working tree at `path`, following a
+    `gitdir:` indirection file, or None if `path` has no `.git`."""
+    dot_git = os.path.join(path, '.git')
+    if os.path.isdir(dot_git):
+        return dot_git
+    if os.path.isfile(dot_git):
+        content = _read(dot_git).strip()
+        if not content.startswith('gitdir:'):
+            raise UnsupportedLayout("%s is not a gitdir file." % dot_git)
+        git_dir = content[len('gitdir:'):].strip()
+        return os.path.normpath(os.path.join(path, git_dir))
+    return None
+
+
+def find_common_dir(git_dir):
+    """Return the directory holding the config, objects and shared refs of
+    `git_dir` (which differs from it for linked worktrees)."""
+    commondir = os.path.join(git_dir, 'commondir')
+    if os.path.isfile(commondir):
+        return os.path.normpath(os.path.join(git_dir,
+            _read(commondir).strip()))
+    return git_dir
+
+
+def is_bare(path):
+    """Return true if `path` looks like a bare repository."""
+    return all([os.path.exists(os.path.join(path, entry)) for entry in
+        ['HEAD', 'objects', 'refs']])
+
+
+def _parse_value(raw):
+    """Parse a config value, handling quotes, escapes and comments."""
+    value = []
+    quoted = False
+    index = 0
+    while index < len(raw):
+        char = raw[index]
+        if char == '\\' and index + 1 < len(raw):
+            index += 1
+            if raw[index] not in _ESCAPES:
+                raise UnsupportedLayout("Unknown escape in config value.")
+            value.append(_ESCAPES[raw[index]])
+        elif char == '"':
+            quoted = not quoted
+        elif char in '#;' and not quoted:
+            break
+        else:
+            value.append(char)
+        index += 1
+    if quoted:
+        raise UnsupportedLayout("Unbalanced quotes in config value.")
+    return ''.join(value).strip()
+
+
+def parse_config(text):
+    """Parse the text of a git config file into a dict mapping
+    `(section, subsection)` to a dict of `key: [values]`. Section and key
+    names are lower cased; subsections are kept as is."""
+    config = {}
+    section = None
+    lines = text.splitlines()
+    while lines:
+        line = lines.pop(0)
+        # Join continuation lines
+        while line.endswith('\\') and not line.endswith('\\\\') and lines:
+            line = line[:-1] + lines.pop(0)
+        stripped = line.strip()
+        if not stripped or stripped[0] in '#;':
+            continue
+        match = _SECTION.match(line)
+        if match:
+            name, subsection, rest = match.groups()
+            if subsection is None and '.' in name:
+                # Deprecated [section.subsection] syntax
+                name, subsection = name.split('.', 1)
+            if name.lower() in ['include', 'includeif']:
+                raise UnsupportedLayout("Config includes are not supported.")
+            section = config.setdefault((name.lower(), subsection), {})
+            if not rest.strip() or rest.strip()[0] in '#;':
+                continue
+            stripped = rest.strip()
+        if section is None:
+            raise UnsupportedLayout("Config entry outside of a section.")
+        if '=' in stripped:
+            key, raw = stripped.split('=', 1)
+            value = _parse_value(raw)
+        else:
+            # A key without a value is a boolean true
+            key, value = stripped, 'true'
+        section.setdefault(key.strip().lower(), []).append(value)
+    return config
+
+
+class RepoMetadata(object):
+    """The metadata of the working tree at `path`, read directly from its git
+    directory. Raises UnsupportedLayout if that is not possible."""
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.git_dir = find_git_dir(path)
+            if self.git_dir is None:
+                raise UnsupportedLayout("%s has no .git." % path)
+            self.common_dir = find_common_dir(self.git_dir)
+            self.config = parse_config(_read(os.path.join(self.common_dir,
+                'config')))
+        except (IOError, OSError) as error:
+            raise UnsupportedLayout(str(error))
+        storage = self.config.get(('extensions', None), {}).get('refstorage')
+        if storage and storage[-1].lower() != 'files':
+            raise UnsupportedLayout("Only the files ref storage is supported.")
+
+    @property
+    def remotes(self):
+        """Return a list of `(name, url)` of the configured remotes."""
+        remotes = []
+        for (section, name), values in self.config.items():
+            if section == 'remote' and name is not None and values.get('url'):
+                remotes.append((name, values['url'][-1]))
+        return remotes
+
+    def remote_url(self, preferred='origin'):
+        """Return the URL of the `preferred` remote, falling back to the first
+        remote (by name), or None if there are no remotes."""
+        remotes = dict(self.remotes)
+        if preferred in remotes:
+            return remotes[preferred]
+        if remotes:
+            return remotes[sorted(remotes)[0]]
+        return None
+
+    def _ref_dirs(self, ref):
+        # Per worktree refs live in the worktree's git directory
+        if ref == 'HEAD' or not ref.startswith('refs/') or \
+                ref.startswith('refs/bisect/') or \
+                ref.startswith('refs/worktree/'):
+            return [self.git_dir]
+        return [self.common_dir]
+
+    def _packed_refs(self):
+        packed = {}
+        path = os.path.join(self.common_dir, 'packed-refs')
+        if os.path.isfile(path):
+            for line in _read(path).splitlines():
+                if line and line[0] not in '#^':
+                    (sha, ref) = line.split(' ', 1)
+                    packed[ref.strip()] = sha
+        return packed
+
+    def resolve(self, ref, depth=5):
+        """Return the sha `ref` points at, or None if it does not exist (e.g.
+        a branch without commits)."""
+        for ref_dir in self._ref_dirs(ref):
+            path = os.path.join(ref_dir, *ref.split('/'))
+            if os.path.isfile(path):
+                try:
+                    content = _read(path).strip()
+                except (IOError, OSError) as error:
+                    raise UnsupportedLayout(str(error))
+                if content.startswith('ref:'):
+                    if depth == 0:
+                        raise UnsupportedLayout("Too many symbolic refs.")
+                    return self.resolve(content[len('ref:'):].strip(),
+                            depth - 1)
+                return content
+        return self._packed_refs().get(ref)
+
+    def head(self):
+        """Return the `(sha, branch)` of HEAD. `branch` is None when HEAD is
+        detached and `sha` is None when there are no commits yet."""
+        try:
+            content = _read(os.path.join(self.git_dir, 'HEAD')).strip()
+        except (IOError, OSError) as error:
+            raise UnsupportedLayout(str(error))
+        if content.startswith('ref:'):
+            ref = content[len('ref:'):].strip()
+            branch = ref[len('refs/heads/'):] if \
+                    ref.startswith('refs/heads/') else None
+            return (self.resolve(ref), branch)
+        return (content, None)
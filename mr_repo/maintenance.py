@@ -0,0 +1,172 @@
+# Author: Ryan McGowan
+"""Disk usage and garbage collection helpers for Mr. Repo workspaces."""
+
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+import os
+import subprocess
+import tempfile
+import yaml
+
+IONICE_CLASSES = {'idle': '3', 'best-effort': '2'}
+
+
+def default_jobs():
+    """Default concurrency cap: half of the available CPUs (at least one)."""
+    try:
+        return max(1, multiprocessing.cpu_count() // 2)
+    except NotImplementedError:
+        return 1
+
+
+def parallel_map(func, items, jobs=None):
+    """Map `func` over `items` using at most `jobs` threads, keeping order."""
+    items = list(items)
+    jobs = max(1, min(jobs or default_jobs(), len(items)))
+    if jobs == 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(jobs)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def which(program):
+    """Return the full path to `program` if it is on the PATH, else None."""
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        candidate = os.path.join(directory, program)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def format_size(num_bytes):
+    """Format a byte count the way `du -h` would."""
+    size = float(num_bytes)
+    for unit in ['B', 'K', 'M', 'G', 'T']:
+        if size < 1024 or unit == 'T':
+            break
+        size /= 1024
+    if unit == 'B':
+        return "%d%s" % (size, unit)
+    return "%.1f%s" % (size, unit)
+
+
+def disk_usage(path):
+    """Return a `(total, git)` tuple of the bytes used on disk by the
+    repository at `path` and by its `.git` directory respectively."""
+    total = 0
+    git_total = 0
+    git_dir = os.path.join(path, '.git')
+    for base, directories, filenames in os.walk(path):
+        in_git = base == git_dir or base.startswith(git_dir + os.sep)
+        for filename in filenames:
+            try:
+                stat = os.lstat(os.path.join(base, filename))
+            except OSError:
+                # Files can disappear under us (e.g. a concurrent gc).
+                continue
+            blocks = getattr(stat, 'st_blocks', None)
+            size = blocks * 512 if blocks is not None else stat.st_size
+            total += size
+            if in_git:
+                git_total += size
+    return (total, git_total)
+
+
+def usage_stamp(path):
+    """Return the stamp used to validate cached usage: the number of
+    directories in the repository and the latest modification time among
+    them. Creating, deleting or renaming a file anywhere in the working tree
+    or the object store (git writes objects, refs and the index by renaming)
+    changes it.
+
+    Computing it still walks the whole tree, only the per file stats are
+    saved. For a 10,000 file checkout it takes about a sixth of the time of
+    disk_usage on Python 3, but over half of it on Python 2 whose os.walk
+    stats every entry to find directories."""
+    count = 0
+    latest = None
+    for base, directories, filenames in os.walk(path):
+        try:
+            mtime = os.stat(base).st_mtime
+        except OSError:
+            continue
+        count += 1
+        latest = mtime if latest is None else max(latest, mtime)
+    return [count, latest]
+
+
+class UsageCache(object):
+    """A YAML backed cache of repository disk usage keyed by repository name
+    and invalidated whenever the repository's stamp changes. An unreadable
+    cache file is treated as empty."""
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.isfile(path):
+            try:
+                with open(path) as cache_file:
+                    loaded = yaml.safe_load(cache_file)
+            except (IOError, yaml.YAMLError):
+                loaded = None
+            if isinstance(loaded, dict):
+                self.entries = loaded
+
+    def get(self, name, stamp):
+        entry = self.entries.get(name)
+        if isinstance(entry, dict) and entry.get('stamp') == stamp:
+            return (entry['total'], entry['git'])
+        return None
+
+    def put(self, name, stamp, usage):
+        self.entries[name] = {'stamp': stamp, 'total': usage[0],
+                'git': usage[1]}
+
+    def prune(self, names):
+        """Forget about every repository not in `names`."""
+        for name in list(self.entries.keys()):
+            if name not in names:
+                del self.entries[name]
+
+    def save(self):
+        # Every writer gets its own temporary file which is renamed into place
+        # so concurrent runs never leave a partially written cache.
+        (handle, temp_path) = tempfile.mkstemp(suffix='.tmp',
+                prefix=os.path.basename(self.path) + '.',
+                dir=os.path.dirname(self.path) or '.')
+        with os.fdopen(handle, 'w') as cache_file:
+            yaml.safe_dump(self.entries, cache_file, default_flow_style=False)
+        os.rename(temp_path, self.path)
+
+
+def gc_command_line(aggressive=False, niceness=None, ionice_class=None):
+    """Build the `git gc` command line, prefixed with `nice`/`ionice` when
+    they are requested and available."""
+    command = ['git', 'gc', '--quiet']
+    if aggressive:
+        command.append('--aggressive')
+    if ionice_class in IONICE_CLASSES and which('ionice'):
+        ionice = ['ionice', '-c', IONICE_CLASSES[ionice_class]]
+        if ionice_class == 'best-effort':
+            ionice.extend(['-n', '7'])
+        command = ionice + command
+    if niceness and which('nice'):
+        command = ['nice', '-n', str(niceness)] + command
+    return command
+
+
+def run_gc(path, command):
+    """Run `command` in the repository at `path` and return a
+    `(returncode, output)` tuple. A command which cannot be started (e.g.
+    `path` or `nice` has disappeared) is reported as a failure too."""
+    try:
+        process = subprocess.Popen(command, cwd=path, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+    except OSError as error:
+        return (None, str(error))
+    output = process.communicate()[0]
+    return (process.returncode, output.decode('utf-8', 'replace').strip())
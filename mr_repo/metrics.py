@@ -0,0 +1,204 @@
+# Author: Ryan McGowan
+"""Operation metrics for Mr. Repo commands.
+
+Every command run through the command line appends one JSON record to a
+rotating metrics file in the Mr. Repo directory. The records can be summarised
+with `mr_repo stats` and optionally exported for the Prometheus node exporter's
+textfile collector.
+"""
+
+from contextlib import contextmanager
+import json
+import os
+import socket
+import tempfile
+import threading
+import git
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locking on this platform (e.g. Windows).
+    fcntl = None
+
+FIELDS = ['repos_scanned', 'bytes_cloned', 'git_subprocesses', 'failures']
+
+PERCENTILES = [50, 90, 99]
+
+
+class Counters(object):
+    """Thread safe counters of the work done by a single command."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.values = dict([(field, 0) for field in FIELDS])
+
+    def add(self, field, amount=1):
+        with self._lock:
+            self.values[field] += amount
+
+
+# Counters currently interested in git subprocesses and the lock guarding them
+_git_counters = []
+_git_counters_lock = threading.Lock()
+_original_execute = git.cmd.Git.execute
+
+
+def _counting_execute(self, *args, **kwargs):
+    with _git_counters_lock:
+        for counters in _git_counters:
+            counters.add('git_subprocesses')
+    return _original_execute(self, *args, **kwargs)
+
+
+@contextmanager
+def counting_git_subprocesses(counters):
+    """Count every git process GitPython spawns during the block in
+    `counters`. Counting is process wide so concurrent blocks in other threads
+    see each other's processes."""
+    with _git_counters_lock:
+        _git_counters.append(counters)
+        git.cmd.Git.execute = _counting_execute
+    try:
+        yield counters
+    finally:
+        with _git_counters_lock:
+            _git_counters.remove(counters)
+            if not _git_counters:
+                git.cmd.Git.execute = _original_execute
+
+
+def make_record(command, start, end, counters, workspace_path, version):
+    """Build the metrics record of a single command."""
+    record = {'command': command, 'timestamp': start,
+            'duration': end - start, 'host': socket.gethostname(),
+            'workspace': os.path.abspath(workspace_path),
+            'version': version}
+    record.update(counters.values)
+    return record
+
+
+def _backup_paths(path, backups):
+    return [path] + ["%s.%d" % (path, index) for index in
+            range(1, backups + 1)]
+
+
+def append(path, record, max_bytes=1024 * 1024, backups=3):
+    """Append `record` to the metrics file at `path`, rotating it (like
+    `logging.handlers.RotatingFileHandler`) once it grows past `max_bytes`."""
+    line = json.dumps(record, sort_keys=True) + '\n'
+    with open(path, 'a') as metrics_file:
+        if fcntl is not None:
+            fcntl.flock(metrics_file.fileno(), fcntl.LOCK_EX)
+        # Another process may have rotated the file while we waited for the
+        # lock, in which case the record goes to the (still read) backup.
+        current = os.path.isfile(path) and os.fstat(
+                metrics_file.fileno()).st_ino == os.stat(path).st_ino
+        metrics_file.seek(0, os.SEEK_END)
+        if current and metrics_file.tell() >= max_bytes:
+            paths = _backup_paths(path, backups)
+            for older, newer in reversed(list(zip(paths[1:], paths[:-1]))):
+                if os.path.isfile(newer):
+                    os.rename(newer, older)
+            with open(path, 'a') as new_file:
+                new_file.write(line)
+        else:
+            metrics_file.write(line)
+
+
+def read(path, backups=3):
+    """Return every record in the metrics file at `path` and its backups,
+    oldest first. Malformed lines are skipped."""
+    records = []
+    for metrics_path in reversed(_backup_paths(path, backups)):
+        if not os.path.isfile(metrics_path):
+            continue
+        with open(metrics_path) as metrics_file:
+            for line in metrics_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(record, dict) and 'command' in record:
+                    records.append(record)
+    return records
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of `values`."""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = int(-(-percent * len(ordered) // 100))
+    return ordered[max(rank, 1) - 1]
+
+
+def summarise(records):
+    """Return `{command: summary}` where each summary holds the run count,
+    duration percentiles and totals of the other fields."""
+    by_command = {}
+    for record in records:
+        by_command.setdefault(record['command'], []).append(record)
+    summaries = {}
+    for command, command_records in by_command.items():
+        durations = [record.get('duration', 0) for record in
+                command_records]
+        summary = {'runs': len(command_records), 'max': max(durations)}
+        for percent in PERCENTILES:
+            summary['p%d' % percent] = percentile(durations, percent)
+        for field in FIELDS:
+            summary[field] = sum([record.get(field, 0) for record in
+                command_records])
+        summaries[command] = summary
+    return summaries
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')
+
+
+def write_textfile(path, records):
+    """Export the latest record of each command (and the number of recorded
+    runs) in the Prometheus text format, atomically replacing `path`."""
+    latest = {}
+    runs = {}
+    for record in records:
+        latest[record['command']] = record
+        runs[record['command']] = runs.get(record['command'], 0) + 1
+
+    gauges = [('last_duration_seconds', 'duration',
+        'Duration of the last run of a Mr. Repo command.'),
+        ('last_run_timestamp_seconds', 'timestamp',
+            'Start time of the last run of a Mr. Repo command.')]
+    gauges.extend([('last_' + field, field,
+        'The %s of the last run of a Mr. Repo command.' %
+        field.replace('_', ' ')) for field in FIELDS])
+
+    lines = []
+    for name, field, description in gauges:
+        lines.append('# HELP mr_repo_%s %s' % (name, description))
+        lines.append('# TYPE mr_repo_%s gauge' % name)
+        for command in sorted(latest):
+            record = latest[command]
+            lines.append('mr_repo_%s{command="%s",workspace="%s"} %s' % (
+                name, _escape(command), _escape(record.get('workspace', '')),
+                repr(float(record.get(field, 0)))))
+    lines.append('# HELP mr_repo_recorded_runs Runs of a Mr. Repo command in '
+            'the metrics history.')
+    lines.append('# TYPE mr_repo_recorded_runs gauge')
+    for command in sorted(runs):
+        lines.append('mr_repo_recorded_runs{command="%s",workspace="%s"} %d'
+                % (_escape(command),
+                    _escape(latest[command].get('workspace', '')),
+                    runs[command]))
+
+    # The collector must never see a partially written file, so every writer
+    # gets its own temporary file which is renamed into place
+    (handle, temp_path) = tempfile.mkstemp(suffix='.tmp',
+            prefix=os.path.basename(path) + '.',
+            dir=os.path.dirname(path) or '.')
+    with os.fdopen(handle, 'w') as textfile:
+        textfile.write('\n'.join(lines) + '\n')
+    os.chmod(temp_path, 0o644)
+    os.rename(temp_path, path)
@@ -1,13 +1,18 @@
 # Author: Ryan McGowan
 
 from argparse import (ArgumentParser, RawDescriptionHelpFormatter, Action,
-        ArgumentTypeError)
+        ArgumentTypeError, SUPPRESS)
+from contextlib import contextmanager
 from textwrap import dedent
 from mr_repo import version
+from mr_repo import completion
+from mr_repo import maintenance
+from mr_repo import metrics
+from mr_repo.workspace import Workspace, MrRepoError
+import logging
 import os
-import shutil
-import yaml
-import git
+import sys
+import time
 
 
 class _MrRepoDirAction(Action):
@@ -26,29 +31,41 @@ class _MrRepoDirAction(Action):
         return apath
 
     def __call__(self, parser, namespace, values, option_string=None):
-        apath = _MrRepoDirAction.check_dir(values, parser._config_file_name,
-                namespace.command == 'init')
-
-        setattr(namespace, self.dest, apath)
+        # Sub-parsers parse into a fresh namespace which does not know the
+        # command yet, so the directory is checked by Repossesser.parse_args.
+        setattr(namespace, self.dest, os.path.normpath(values))
 
 
 class Repossesser(object):
     """
     The Repossesser class used to do all of the dirty work behind Mr. Repo.
 
-    This class contains the basic functionality of the Mr. Repo project
-    including the argument parser, and `.mr_repo.yml` and `.this_repo`
-    management.
+    This class contains the command line interface of the Mr. Repo project.
+    It parses arguments and formats results while the actual work (including
+    `.mr_repo.yml` and `.this_repo` management) is done by a Workspace.
     """
 
+    # Commands which also work outside of a Mr. Repo repository
+    _repo_optional_commands = ['completion']
+    # Commands which do not append to the metrics history
+    _unrecorded_commands = ['stats', 'completion']
+
     def __init__(self, prog='mr_repo', args=None, execute=False, quiet=False,
             config_file=".mr_repo.yml", repo_file='.this_repo', one_use=False,
-            verbose=False):
-        self.config = {'repos': {}}
-        self.repos = []
+            verbose=False, du_cache_file='.mr_repo_du.yml',
+            lock_file='.mr_repo_lock.yml',
+            metrics_file='.mr_repo_metrics.log',
+            completion_file='.mr_repo_complete'):
+        self.workspace = None
+        self._config = {'repos': {}}
+        self._repos = []
         self._command_term = 'command'
         self._config_file_name = config_file
         self._repo_file_name = repo_file
+        self._du_cache_file_name = du_cache_file
+        self._lock_file_name = lock_file
+        self._metrics_file_name = metrics_file
+        self._completion_file_name = completion_file
         self.verbose = verbose
 
         # Setup parser
@@ -93,7 +110,13 @@ class Repossesser(object):
         self.parser.add_argument('--dir', '-d', dest="dir", default='.',
                 help='The Mr. Repo directory being worked on.',
                 action=_MrRepoDirAction)
-        subparsers = self.parser.add_subparsers(
+        self.parser.add_argument('--prometheus-textfile',
+                dest='prometheus_textfile',
+                default=os.environ.get('MR_REPO_PROMETHEUS_TEXTFILE'),
+                help='Export metrics to this file for the Prometheus ' \
+                        'textfile collector (defaults to ' \
+                        '$MR_REPO_PROMETHEUS_TEXTFILE).')
+        subparsers = self._subparsers = self.parser.add_subparsers(
                 title='Commands',
                 description='Valid Mr. Repo commands:',
                 dest=self._command_term,
@@ -129,20 +152,21 @@ class Repossesser(object):
         # Parser for `add` command
         add_parser = subparsers.add_parser('add',
                 description=dedent(self.add_command.__doc__))
-        add_parser.add_argument('path', help='Path to the repository being ' \
-                'put under Mr. Repo control', type=self.__path)
+        add_parser.add_argument('path', nargs='+', help='Paths to the ' \
+                'repositories being put under Mr. Repo control',
+                type=self.__path)
         add_parser.set_defaults(func=self.add_command)
         # Parser for `rm` command
         rm_parser = subparsers.add_parser('rm',
                 description=dedent(self.rm_command.__doc__))
-        rm_parser.add_argument('name', help='Name of the repository being ' \
-                'removed from Mr. Repo control')
+        rm_parser.add_argument('name', nargs='+', help='Names of the ' \
+                'repositories being removed from Mr. Repo control')
         rm_parser.set_defaults(func=self.rm_command)
         # Parser for `get` command
         get_parser = subparsers.add_parser('get',
                 description=dedent(self.get_command.__doc__))
-        get_parser.add_argument('name', help='Name of the repository being ' \
-                'pulled into the local  Mr. Repo repo')
+        get_parser.add_argument('name', nargs='+', help='Names of the ' \
+                'repositories being pulled into the local Mr. Repo repo')
         get_parser.set_defaults(func=self.get_command)
 
         # Parser for `unget` command
@@ -151,8 +175,8 @@ class Repossesser(object):
         unget_parser.add_argument('--force', '-f', dest='force',
                 action='store_true', default=False, help='Force removal of ' \
                         'repository even if it contains uncommitted changes.')
-        unget_parser.add_argument('name', help='Name of the repository ' \
-                'being removed from the local Mr. Repo repo')
+        unget_parser.add_argument('name', nargs='+', help='Names of the ' \
+                'repositories being removed from the local Mr. Repo repo')
         unget_parser.set_defaults(func=self.unget_command)
 
         # Parser for `update` command
@@ -165,14 +189,111 @@ class Repossesser(object):
         # --all to show all repos (currently available or not)
         update_parser.set_defaults(func=self.update_command)
 
+        # Parser for `du` command
+        du_parser = subparsers.add_parser('du',
+                formatter_class=RawDescriptionHelpFormatter,
+                description=dedent(self.du_command.__doc__))
+        du_parser.add_argument('--jobs', '-j', dest='jobs', type=int,
+                default=None, help='Maximum number of repositories to ' \
+                        'measure at once (defaults to half the CPUs).')
+        du_parser.add_argument('--no-cache', dest='no_cache',
+                action='store_true', default=False, help='Ignore cached ' \
+                        'sizes and measure every repository again.')
+        du_parser.set_defaults(func=self.du_command)
+
+        # Parser for `gc` command
+        gc_parser = subparsers.add_parser('gc',
+                formatter_class=RawDescriptionHelpFormatter,
+                description=dedent(self.gc_command.__doc__))
+        gc_parser.add_argument('--jobs', '-j', dest='jobs', type=int,
+                default=None, help='Maximum number of repositories to ' \
+                        'collect at once (defaults to half the CPUs).')
+        gc_parser.add_argument('--nice', '-n', dest='niceness', type=int,
+                default=10, help='Niceness to run `git gc` with (0 to ' \
+                        'disable, defaults to 10).')
+        gc_parser.add_argument('--ionice', '-i', dest='ionice',
+                choices=['idle', 'best-effort', 'none'],
+                default='best-effort', help='I/O scheduling class to run ' \
+                        '`git gc` with (defaults to best-effort).')
+        gc_parser.add_argument('--aggressive', dest='aggressive',
+                action='store_true', default=False, help='Pass ' \
+                        '`--aggressive` on to `git gc`.')
+        gc_parser.add_argument('names', nargs='*', help='Names of the ' \
+                'repositories to collect (defaults to all available).')
+        gc_parser.set_defaults(func=self.gc_command)
+
+        # Parser for `freeze` command
+        freeze_parser = subparsers.add_parser('freeze',
+                formatter_class=RawDescriptionHelpFormatter,
+                description=dedent(self.freeze_command.__doc__))
+        freeze_parser.add_argument('--jobs', '-j', dest='jobs', type=int,
+                default=None, help='Maximum number of repositories to ' \
+                        'read at once (defaults to half the CPUs).')
+        freeze_parser.add_argument('names', nargs='*', help='Names of the ' \
+                'repositories to freeze (defaults to all available).')
+        freeze_parser.set_defaults(func=self.freeze_command)
+
+        # Parser for `restore` command
+        restore_parser = subparsers.add_parser('restore',
+                formatter_class=RawDescriptionHelpFormatter,
+                description=dedent(self.restore_command.__doc__))
+        restore_parser.add_argument('--jobs', '-j', dest='jobs', type=int,
+                default=None, help='Maximum number of repositories to ' \
+                        'restore at once (defaults to half the CPUs).')
+        restore_parser.add_argument('--force', '-f', dest='force',
+                action='store_true', default=False, help='Restore ' \
+                        'repositories even if they contain uncommitted ' \
+                        'changes.')
+        restore_parser.add_argument('names', nargs='*', help='Names of the ' \
+                'repositories to restore (defaults to all in the lockfile).')
+        restore_parser.set_defaults(func=self.restore_command)
+
+        # Parser for `stats` command
+        stats_parser = subparsers.add_parser('stats',
+                formatter_class=RawDescriptionHelpFormatter,
+                description=dedent(self.stats_command.__doc__))
+        stats_parser.add_argument('commands', nargs='*', help='Commands to ' \
+                'summarise (defaults to all recorded commands).')
+        stats_parser.set_defaults(func=self.stats_command)
+
+        # Parser for `sparse` command
+        sparse_parser = subparsers.add_parser('sparse',
+                formatter_class=RawDescriptionHelpFormatter,
+                description=dedent(self.sparse_command.__doc__))
+        sparse_parser.add_argument('--patterns', '-p', dest='patterns',
+                nargs='+', default=None, help='(Re)define the profile as ' \
+                        'these sparse checkout patterns.')
+        sparse_parser.add_argument('--force', '-f', dest='force',
+                action='store_true', default=False, help='Reshape the ' \
+                        'repository even if it contains uncommitted changes.')
+        sparse_parser.add_argument('name', help='Name of the repository ' \
+                'being reshaped.')
+        sparse_parser.add_argument('profile', help="Sparse checkout " \
+                "profile to use ('full' checks out everything).")
+        sparse_parser.set_defaults(func=self.sparse_command)
+
+        # Parser for `completion` command
+        completion_parser = subparsers.add_parser('completion',
+                formatter_class=RawDescriptionHelpFormatter,
+                description=dedent(self.completion_command.__doc__))
+        completion_parser.add_argument('shell', choices=completion.SHELLS,
+                help='Shell to generate the completion script for.')
+        completion_parser.set_defaults(func=self.completion_command)
+
         for sp in subparsers.choices.values():
             sp._config_file_name = self._config_file_name
-            sp.add_argument('--dir', '-d', dest="dir", default='.',
+            # Suppress the default so it cannot override a `--dir` given
+            # before the command.
+            sp.add_argument('--dir', '-d', dest="dir", default=SUPPRESS,
                     help='The Mr. Repo directory being worked on.',
                     action=_MrRepoDirAction)
             sp.add_argument('--verbose', '-v', dest="verbose", default=False,
                     help='Run this command verbosely to show debug output.',
                     action='store_true')
+            sp.add_argument('--prometheus-textfile',
+                    dest='prometheus_textfile', default=SUPPRESS,
+                    help='Export metrics to this file for the Prometheus ' \
+                            'textfile collector.')
 
     def __path(self, spath):
         extra = " so it cannot be added to Mr. Repo."
@@ -180,7 +301,7 @@ class Repossesser(object):
         if not os.path.isdir(apath):
             raise ArgumentTypeError("%s is not a directory" % spath +
                     extra)
-        if self._get_repo(apath) == None:
+        if not Workspace.is_repo(apath):
             raise ArgumentTypeError("%s is not a valid repository" % spath +
                     extra)
         return apath
@@ -191,32 +312,81 @@ class Repossesser(object):
         if self.verbose:
             print("DEBUG: " + str(debugging_info))
 
-    @classmethod
-    def _get_repo(cls, apath):
+    @contextmanager
+    def _workspace_debug_output(self):
+        """Print the Workspace's debug log during the block when running
+        verbosely."""
+        if not self.verbose:
+            yield
+            return
+        logger = logging.getLogger('mr_repo.workspace')
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter("DEBUG: %(message)s"))
+        level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        try:
+            yield
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+
+    def _metrics_path(self):
+        return os.path.join(self.args.dir, self._metrics_file_name)
+
+    def _record(self, start, end, counters):
+        """Append the metrics of the command just run to the metrics file
+        and optionally export them for Prometheus."""
         try:
-            repo = git.Repo(apath)
-        except:
-            return None
-        return repo
+            metrics.append(self._metrics_path(), metrics.make_record(
+                self.args.command, start, end, counters, self.args.dir,
+                version))
+            textfile = getattr(self.args, 'prometheus_textfile', None)
+            if textfile:
+                metrics.write_textfile(textfile,
+                        metrics.read(self._metrics_path()))
+        except (IOError, OSError) as error:
+            # Never fail a command because its metrics could not be saved
+            self._debug("Could not record metrics: " + str(error))
+
+    @classmethod
+    def _format(cls, results):
+        """Turn a list of Workspace results into command output."""
+        return '\n'.join([result.message if result.ok else
+            "ERROR: " + result.message for result in results])
+
+    @classmethod
+    def _as_list(cls, value):
+        return value if isinstance(value, list) else [value]
 
     @classmethod
     def find_repos(cls, start_path, max_depth=4):
-        found_repos = []
-        if max_depth >= 0:
-            (base_path, directories, filenames) = os.walk(start_path,
-                    followlinks=True).next()
-            for directory in directories:
-                directory = os.path.join(start_path, directory)
-                directory_repo = cls._get_repo(directory)
-                if isinstance(directory_repo, git.Repo):
-                    found_repos.append(os.path.normpath(directory))
-                else:
-                    found_repos.extend(cls.find_repos(directory,
-                        max_depth - 1))
-        return found_repos
+        return Workspace.find_repos(start_path, max_depth)
 
     # Public functions
 
+    @property
+    def config(self):
+        return self.workspace.config if self.workspace else self._config
+
+    @config.setter
+    def config(self, value):
+        if self.workspace:
+            self.workspace.config = value
+        else:
+            self._config = value
+
+    @property
+    def repos(self):
+        return self.workspace.repos if self.workspace else self._repos
+
+    @repos.setter
+    def repos(self, value):
+        if self.workspace:
+            self.workspace.repos = value
+        else:
+            self._repos = value
+
     def check_repo_name(self, name):
         repo_name = os.path.basename(os.path.normpath(name))
         if self.is_controlled_repo(repo_name):
@@ -225,34 +395,23 @@ class Repossesser(object):
             return False
 
     def setup_files(self):
-        temp_config_path = os.path.join(self.args.dir, self._config_file_name)
-        temp_repo_file_path = os.path.join(self.args.dir, self._repo_file_name)
-
-        # If the config files do not exist, create them
-        if not os.path.isfile(temp_config_path):
-            open(temp_config_path, 'w')
-        if not os.path.isfile(temp_repo_file_path):
-            open(temp_repo_file_path, 'w')
-
-        # Follow the link if it exists
-        self.config_path = temp_config_path if \
-                (not os.path.islink(temp_config_path)) else \
-                os.readlink(temp_config_path)
-        self.repo_file_path = temp_repo_file_path if \
-                (not os.path.islink(temp_repo_file_path)) else \
-                os.readlink(temp_repo_file_path)
-
-        self.config_file = open(self.config_path, 'r+')
-        self.repo_file = open(self.repo_file_path, 'r+')
+        """Create the Workspace for the Mr. Repo directory being worked on.
+        The tracking files are only opened while they are read or written."""
+        self.workspace = Workspace(self.args.dir,
+                config_file=self._config_file_name,
+                repo_file=self._repo_file_name,
+                du_cache_file=self._du_cache_file_name,
+                lock_file=self._lock_file_name,
+                completion_file=self._completion_file_name, create=True)
+        self.config_path = self.workspace.config_path
+        self.repo_file_path = self.workspace.repo_file_path
+        if self.is_init:
+            self.workspace._ensure_files()
 
     def read_config(self, check=True):
         """Read `.mr_repo.yml` and `.this_repo` files to determine state the of
         the repository."""
-        self.config_file.seek(0)
-        self.config = yaml.load(self.config_file)
-        self.repo_file.seek(0)
-        self.repos = filter(self.is_controlled_repo, [repo.rstrip() for repo in
-            self.repo_file.readlines()])
+        self.workspace.load()
         if check:
             self.check_config()
 
@@ -264,33 +423,26 @@ class Repossesser(object):
             self.read_config()
 
         #Check that self.repos is a list of strings
-        repos_ok = isinstance(self.repos, list) and len(filter(lambda x: not \
-                isinstance(x, str), self.repos)) == 0
+        repos_ok = isinstance(self.repos, list) and len([x for x in
+            self.repos if not isinstance(x, str)]) == 0
 
         #Check to make sure that each entry in config has valid keys/values
         config_ok = isinstance(self.config, dict)
         if config_ok:
             try:
-                config_ok = filter(lambda x: isinstance(x[0], str) and
-                        isinstance(x[1], dict), self.config)
+                config_ok = [x for x in self.config.items() if
+                        isinstance(x[0], str) and isinstance(x[1], dict)]
             except:
                 config_ok = False
 
         return {'repos': repos_ok, 'config': config_ok}
 
-    def write_config(self):
-        """Write config to config file."""
-        # Delete contents of files
-        self.config_file.seek(0)
-        self.config_file.truncate()
-        self.repo_file.seek(0)
-        self.repo_file.truncate()
-
-        # Write contents to files
-        yaml.dump(self.config, self.config_file)
-        self.repo_file.write('\n'.join(self.repos))
-        if len(self.repos) > 0:
-            self.repo_file.write('\n')
+    def write_config(self, merge=None):
+        """Write config to config file, merging in concurrent changes unless
+        `merge` is false (the default when running `init`)."""
+        if merge is None:
+            merge = not getattr(self, 'is_init', False)
+        self.workspace.save(merge=merge)
 
     def parse_args(self, args):
         try:
@@ -298,9 +450,9 @@ class Repossesser(object):
             self.is_init = self.args.command == 'init'
             if hasattr(self.args, 'verbose'):
                 self.verbose = self.verbose or self.args.verbose
-            if self.args.dir == '.':
-                self.args.dir = _MrRepoDirAction.check_dir(self.args.dir,
-                        self._config_file_name, self.is_init)
+            self.args.dir = _MrRepoDirAction.check_dir(self.args.dir,
+                    self._config_file_name, self.is_init or
+                    self.args.command in self._repo_optional_commands)
         except ArgumentTypeError as inst:
             print(inst.message)
             print(str(self.args))
@@ -311,20 +463,33 @@ class Repossesser(object):
         return repo_str in self.config.get('repos').keys()
 
     def execute(self):
+        with self._workspace_debug_output():
+            return self._execute()
+
+    def _execute(self):
         if callable(self.args.func):
-            result = self.args.func()
+            if self.args.command in self._unrecorded_commands or \
+                    self.workspace is None or not self._metrics_file_name:
+                return self.args.func()
+            counters = self.workspace.counters = metrics.Counters()
+            start = time.time()
+            try:
+                with metrics.counting_git_subprocesses(counters):
+                    result = self.args.func()
+            except:
+                counters.add('failures')
+                raise
+            finally:
+                self._record(start, time.time(), counters)
         else:
             print("INTERNAL ERROR: Couldn't parse arguments!")
             self.parser.print_help()
         return result
 
     def close(self):
-        """Close the config files."""
-        if hasattr(self, 'config_file') and isinstance(self.config_file,
-                file):
-            self.config_file.close()
-        if hasattr(self, 'repo_file') and isinstance(self.repo_file, file):
-            self.repo_file.close()
+        """Kept for backwards compatibility; the Workspace only keeps the
+        config files open while reading or writing them."""
+        pass
 
     # Mr. Repo Commands
 
@@ -336,60 +501,19 @@ class Repossesser(object):
         repositories and adds them to the tracking files.  This feature can be
         overridden with the `--clean` option.'
         """
-        if not self.args.clean:
-            self.update_command()
-        self.write_config()
-        return "Successfully initialized Mr. Repo at '%s'." % self.args.dir
+        return self.workspace.init(clean=self.args.clean).message
 
     def add_command(self, path=None):
-        """Add a definition of a local repository to the Mr. Repo
+        """Add definitions of local repositories to the Mr. Repo
         repository."""
-        # Path relative to CWD
-        cur_rel_path = os.path.normpath(path or self.args.path)
-        # Path relative to Mr. Repo directory
-        mr_rel_path = os.path.relpath(cur_rel_path, self.args.dir)
-
-        repo_name = os.path.basename(mr_rel_path)
-
-        if not self.is_controlled_repo(repo_name):
-            rep = self._get_repo(cur_rel_path)
-            if rep != None:
-                self.repos.append(os.path.basename(repo_name))
-                if len(rep.remotes) > 0:
-                    repo_dict = {repo_name: {'type': 'Git',
-                        'remote': rep.remote().url, 'path': mr_rel_path}}
-                else:
-                    repo_dict = {
-                            repo_name: {
-                                'type': 'Git', 'path': mr_rel_path}}
-                self._debug("Adding to config: " + str(repo_dict))
-                self.config.get('repos').update(repo_dict)
-                self.write_config()
-                result = "Successfully added '%s' to Mr. Repo." % repo_name
-            else:
-                result = "ERROR: %s is not a supported repository." % \
-                        cur_rel_path
-        else:
-            result = ("ERROR: %s is already controlled by Mr. Repo (i.e "
-                    "it is in %s).") % (repo_name, self._config_file_name)
-        return result
+        return self._format(self.workspace.add(
+            self._as_list(path or self.args.path)))
 
     def rm_command(self):
-        """Remove a definition of a local repository from the Mr. Repo
+        """Remove definitions of local repositories from the Mr. Repo
         repository. Nothing is removed from the filesystem (use `unget` for
         that."""
-        name = self.check_repo_name(self.args.name)
-
-        if name:
-            self.config['repos'].pop(name)
-            if name in self.repos:
-                self.repos.remove(name)
-            ret = "Successfully removed '%s' from Mr. Repo control." % name
-            self.write_config()
-        else:
-            ret = "ERROR: '%s' is not a Mr. Repo controlled repository." % name
-
-        return ret
+        return self._format(self.workspace.rm(self._as_list(self.args.name)))
 
     def list_command(self):
         """
@@ -399,17 +523,14 @@ class Repossesser(object):
         Command line flags ([-a | -all] or [-u | --unavailable]) may be used
         to specify which Mr. Repo repositories are listed.
         """
-        repos = self.config['repos']
-
         # Filter down all repos if we do not have the all flag or were given
         # the unavailable flag.
         if hasattr(self.args, 'unavailable') and self.args.unavailable:
-            # Unavailable means it is in the config, but not in self.repos.
-            repos = dict(filter(lambda x: x[0] not in self.repos,
-                repos.items()))
-        elif not (hasattr(self.args, 'all') and self.args.all):
-            # The default, filter so that only available repos get through
-            repos = dict(filter(lambda x: x[0] in self.repos, repos.items()))
+            repos = self.workspace.list('unavailable')
+        elif hasattr(self.args, 'all') and self.args.all:
+            repos = self.workspace.list('all')
+        else:
+            repos = self.workspace.list('available')
 
         max_repo_length = 0
         for key in repos.keys():
@@ -423,85 +544,178 @@ class Repossesser(object):
                 for key, item in repos.items()])
 
     def get_command(self):
-        """Get a repository defined in the Mr. Repo repository, but not
+        """Get repositories defined in the Mr. Repo repository, but not
         available locally."""
-        name = self.check_repo_name(self.args.name)
-
-        if name:
-            if 'remote' in self.config['repos'][name]:
-                remote = self.config['repos'][name]['remote']
-                repo_type = self.config['repos'][name]['type']
-                repo_path = os.path.relpath(os.path.join(self.args.dir,
-                        self.config['repos'][name]['path'] or name))
-                if repo_type == "Git":
-                    new_repo = git.Repo.clone_from(remote, repo_path)
-                    self.repos.append(name)
-                    ret = "Successfully cloned '%s' into '%s'." % (name,
-                        new_repo.working_dir)
-                    self.write_config()
-                else:
-                    ret = "ERROR: Repositories of type '%s' are not " % \
-                            repo_type + "supported"
-            else:
-                ret = "ERROR: %s does not have an associated " % name + \
-                        "remote to repossess it from."
-        else:
-            ret = "ERROR: '%s' is not a Mr. Repo controlled repository." % name
-
-        return ret
+        return self._format(self.workspace.get(self._as_list(self.args.name)))
 
     def unget_command(self):
-        """Remove a repository defined in the Mr. Repo repository from the
+        """Remove repositories defined in the Mr. Repo repository from the
         local system."""
-        name = self.check_repo_name(self.args.name)
-
-        if name and name in self.repos:
-            repo_path = os.path.relpath(os.path.join(self.args.dir,
-                    self.config['repos'][name]['path'] or name))
-            repo_type = self.config['repos'][name]['type']
-            ret = "Successfully removed the local copy of '%s'." % name
-            # Check that it is a Git repo
-            if repo_type == 'Git':
-                repo = git.Repo(repo_path)
-                # If we aren't forcing removal make sure it isn't dirty
-                if not (hasattr(self.args, 'force') and self.args.force) and \
-                        repo.is_dirty():
-                    ret = "ERROR: '%s' is dirty. Fix it or use the " \
-                            "`--force` option to force it's removal." % name
-                else:
-                    # Everything is ok. So we now do the removing
-                    shutil.rmtree(repo_path)
-                    self.repos.remove(name)
-            else:
-                ret = "ERROR: Repositories of type '%s' are not supported " % \
-                        repo_type
-        else:
-            ret = "ERROR: '%s' is not a currently checked out Mr. Repo " \
-                    "controlled repository." % name
-        return ret
+        return self._format(self.workspace.unget(
+            self._as_list(self.args.name),
+            force=hasattr(self.args, 'force') and self.args.force))
 
     def update_command(self):
         """Interprets Mr. Repo controlled directory and automatically updates
         tracking files based on its findings."""
-        start_len = len(self.repos)
-        repos = filter(lambda x: not self.is_controlled_repo(x),
-                self.find_repos(self.args.dir if not hasattr(self.args, 'path')
-                    else self.args.path))
-
-        if hasattr(self.args, "current") and self.args.current:
-            # Unavailable means it is in the config, but not in self.repos.
-            repos = dict(filter(lambda x: x[0] in self.repos,
-                repos.items()))
-
-        # Add all of the repos
-        map(self.add_command, repos)
-        difference = len(self.repos) - start_len
+        difference = len([result for result in self.workspace.update() if
+            result.ok])
         if difference > 0:
             success_str = "Successfully added %d new repositories." % \
                     difference
-        elif difference < 0:
-            success_str = "Successfully removed %d repositories." % \
-                    difference
         else:
             success_str = "No updates made to controlled repos."
         return success_str
+
+    def du_command(self):
+        """
+        Report disk usage of the available repositories.
+
+        Repositories are measured in parallel. Sizes are cached in
+        `.mr_repo_du.yml` and only recomputed for repositories in which a file
+        or directory has been created, deleted or renamed since they were last
+        measured. Checking that still walks every directory, so cache hits
+        save the per file work only. Use `--no-cache` to measure everything
+        again.
+        """
+        usages = self.workspace.du(jobs=getattr(self.args, 'jobs', None),
+                use_cache=not getattr(self.args, 'no_cache', False))
+        if len(usages) == 0:
+            return "No repositories are currently available."
+        max_repo_length = max([len(x[0]) for x in usages] + [len('total')])
+        lines = [name.ljust(max_repo_length) + " - %s (git: %s)" % (
+            maintenance.format_size(total), maintenance.format_size(git_total))
+            for name, total, git_total in usages]
+        lines.append('total'.ljust(max_repo_length) + " - %s (git: %s)" % (
+            maintenance.format_size(sum([x[1] for x in usages])),
+            maintenance.format_size(sum([x[2] for x in usages]))))
+        return '\n'.join(lines)
+
+    def gc_command(self):
+        """
+        Run `git gc` over the available repositories.
+
+        At most `--jobs` repositories are collected at once and each `git gc`
+        runs under `nice` and `ionice` (when they are installed) so that
+        maintenance can happen without starving other work on the machine.
+        """
+        results = self.workspace.gc(names=getattr(self.args, 'names', None),
+                jobs=getattr(self.args, 'jobs', None),
+                niceness=getattr(self.args, 'niceness', 10),
+                ionice=getattr(self.args, 'ionice', 'best-effort'),
+                aggressive=getattr(self.args, 'aggressive', False))
+        errors = [result for result in results if not result.ok]
+        if errors:
+            return self._format(errors)
+        return "Successfully collected %d repositories." % len(results)
+
+    def freeze_command(self):
+        """
+        Record the commit and branch of the available repositories.
+
+        The HEAD commit and branch of every available repository (or just the
+        ones named) are read in parallel and written to `.mr_repo_lock.yml`.
+        Use `restore` to check those commits out again.
+        """
+        try:
+            results = self.workspace.freeze(
+                    names=getattr(self.args, 'names', None),
+                    jobs=getattr(self.args, 'jobs', None))
+        except MrRepoError as error:
+            return "ERROR: " + str(error)
+        if len(results) == 0:
+            return "No repositories are currently available."
+        return self._format(results)
+
+    def restore_command(self):
+        """
+        Check out the commits recorded by `freeze`.
+
+        Repositories in `.mr_repo_lock.yml` which are not available are
+        cloned and every repository is checked out at its recorded commit, in
+        parallel. Repositories already at the right commit are skipped.
+        """
+        try:
+            results = self.workspace.restore(
+                    names=getattr(self.args, 'names', None),
+                    jobs=getattr(self.args, 'jobs', None),
+                    force=getattr(self.args, 'force', False))
+        except MrRepoError as error:
+            return "ERROR: " + str(error)
+        if len(results) == 0:
+            return "No repositories are recorded in %s." % \
+                    self._lock_file_name
+        return self._format(results)
+
+    def stats_command(self):
+        """
+        Summarise the recorded metrics of Mr. Repo commands.
+
+        Every command run in this Mr. Repo repository appends its duration,
+        the number of repositories it scanned, the bytes it cloned, the git
+        processes it spawned and its failures to `.mr_repo_metrics.log`
+        (which is rotated as it grows). This command reports the number of
+        runs, duration percentiles and totals for each command.
+        """
+        summaries = metrics.summarise(metrics.read(self._metrics_path()))
+        commands = getattr(self.args, 'commands', None) or \
+                sorted(summaries.keys())
+        header = ['command', 'runs'] + ['p%d' % percent for percent in
+                metrics.PERCENTILES] + ['max', 'repos', 'cloned', 'git',
+                        'failures']
+        rows = [header]
+        for command in commands:
+            if command not in summaries:
+                continue
+            summary = summaries[command]
+            rows.append([str(command), str(summary['runs'])] +
+                    ["%.2fs" % summary['p%d' % percent] for percent in
+                        metrics.PERCENTILES] +
+                    ["%.2fs" % summary['max'], str(summary['repos_scanned']),
+                        maintenance.format_size(summary['bytes_cloned']),
+                        str(summary['git_subprocesses']),
+                        str(summary['failures'])])
+        if len(rows) == 1:
+            return "No metrics have been recorded yet."
+        widths = [max([len(row[column]) for row in rows]) for column in
+                range(len(header))]
+        return '\n'.join(['  '.join([row[0].ljust(widths[0])] +
+            [value.rjust(width) for value, width in zip(row[1:], widths[1:])])
+            for row in rows])
+
+    def sparse_command(self):
+        """
+        Select the sparse checkout profile of a repository.
+
+        Profiles are lists of sparse checkout patterns kept under
+        `sparse_profiles` in the repository's entry in `.mr_repo.yml` (use
+        `--patterns` to define one). The selected profile is stored as
+        `sparse` and applied when the repository is cloned by `get`. If the
+        repository is available its working tree is reshaped right away
+        (unless it has uncommitted changes and `--force` is not given). The
+        profile `full` checks out everything again and takes no patterns.
+        """
+        return self._format([self.workspace.sparse(self.args.name,
+            self.args.profile, patterns=getattr(self.args, 'patterns',
+                None), force=getattr(self.args, 'force', False))])
+
+    def completion_command(self):
+        """
+        Print a bash or zsh completion script for Mr. Repo.
+
+        The script completes commands, options and repository names without
+        running Mr. Repo: names are read from the `.mr_repo_complete` index
+        which is rewritten whenever the tracking files are. Running this
+        command inside a Mr. Repo repository also refreshes its index.
+
+            source <(mr_repo completion bash)
+        """
+        if os.path.isfile(self.workspace.config_path):
+            self.workspace.write_completion_index()
+        commands = dict([(name, [option for action in sp._actions for option
+            in action.option_strings]) for name, sp in
+            self._subparsers.choices.items()])
+        global_options = [option for action in self.parser._actions for
+                option in action.option_strings]
+        return completion.script(self.args.shell, global_options, commands,
+                self._completion_file_name).rstrip('\n')
@@ -0,0 +1,790 @@
+# Author: Ryan McGowan
+"""Programmatic interface to a Mr. Repo controlled directory.
+
+The Workspace class implements every Mr. Repo operation without argparse,
+printing or long lived file handles so it can be embedded in other tools. The
+`mr_repo` command line interface (see Repossesser) is a thin wrapper around it.
+"""
+
+from collections import namedtuple
+from contextlib import contextmanager
+from mr_repo import completion
+from mr_repo import gitmeta
+from mr_repo import maintenance
+from mr_repo import metrics
+import copy
+import logging
+import os
+import shutil
+import tempfile
+import yaml
+import git
+
+try:
+    import fcntl
+except ImportError:
+    # No advisory locking on this platform (e.g. Windows).
+    fcntl = None
+
+# Debug output goes to this logger; the command line prints it with --verbose
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+
+class MrRepoError(Exception):
+    """Base class of all errors raised by Mr. Repo."""
+
+
+class NotAWorkspaceError(MrRepoError):
+    """Raised when a directory is not (and cannot be) a Mr. Repo repo."""
+
+
+class RepoError(MrRepoError):
+    """Raised when an operation on a single repository fails."""
+
+
+# The outcome of an operation on a single repository. Batch operations return
+# one Result per repository instead of stopping at the first failure. The
+# message is always human readable; operations producing structured output
+# (e.g. freeze) put it in data, which is None otherwise.
+Result = namedtuple('Result', ['name', 'ok', 'message', 'data'])
+Result.__new__.__defaults__ = (None,)
+
+
+class Workspace(object):
+    """
+    A Mr. Repo controlled directory.
+
+    The tracking files (`.mr_repo.yml` and `.this_repo`) are only opened while
+    they are being read or written. Reads hold a shared advisory lock and
+    writes an exclusive one. Before writing, the files are re-read and only the
+    changes made through this instance are applied so concurrent users of the
+    same directory do not lose each other's entries.
+    """
+
+    def __init__(self, path='.', config_file='.mr_repo.yml',
+            repo_file='.this_repo', du_cache_file='.mr_repo_du.yml',
+            lock_file='.mr_repo_lock.yml',
+            completion_file='.mr_repo_complete', create=False):
+        self.path = os.path.normpath(path)
+        self.config_file_name = config_file
+        self.repo_file_name = repo_file
+        self.du_cache_file_name = du_cache_file
+        self.lock_file_name = lock_file
+        self.completion_file_name = completion_file
+        # Work done through this workspace, see mr_repo.metrics
+        self.counters = metrics.Counters()
+        self.config = {'repos': {}}
+        self.repos = []
+        self._snapshot()
+
+        if not os.path.isdir(self.path):
+            raise NotAWorkspaceError("%s is not a directory." % self.path)
+        temp_config_path = os.path.join(self.path, config_file)
+        temp_repo_file_path = os.path.join(self.path, repo_file)
+        if not (create or os.path.isfile(temp_config_path)):
+            raise NotAWorkspaceError("%s is not a Mr. Repo repo." % self.path)
+
+        # Follow the link if it exists
+        self.config_path = temp_config_path if \
+                (not os.path.islink(temp_config_path)) else \
+                os.readlink(temp_config_path)
+        self.repo_file_path = temp_repo_file_path if \
+                (not os.path.islink(temp_repo_file_path)) else \
+                os.readlink(temp_repo_file_path)
+
+    # Pseudo private functions
+
+    def _repo_path(self, name):
+        """Path of the controlled repository `name`."""
+        return os.path.join(self.path,
+                self.config['repos'][name].get('path') or name)
+
+    def _ensure_files(self):
+        """Create the tracking files if they do not exist (appending so that a
+        file created by a concurrent process in the meantime is kept
+        intact)."""
+        for path in [self.config_path, self.repo_file_path]:
+            if not os.path.isfile(path):
+                open(path, 'a').close()
+
+    @contextmanager
+    def _open(self, exclusive=False):
+        """Open the tracking files for the duration of the block while holding
+        an advisory lock on the config file. Readers share the lock, writers
+        hold it exclusively."""
+        if exclusive:
+            self._ensure_files()
+        mode = 'r+' if exclusive else 'r'
+        config_file = open(self.config_path, mode)
+        try:
+            if fcntl is not None:
+                fcntl.flock(config_file.fileno(),
+                        fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            if os.path.isfile(self.repo_file_path):
+                repo_file = open(self.repo_file_path, mode)
+            else:
+                repo_file = None
+            try:
+                yield (config_file, repo_file)
+            finally:
+                if repo_file is not None:
+                    repo_file.close()
+        finally:
+            # Closing the file releases the lock
+            config_file.close()
+
+    @classmethod
+    def _read_files(cls, config_file, repo_file):
+        """Return the `(config, repos)` stored in the given tracking files."""
+        config_file.seek(0)
+        config = yaml.load(config_file) or {}
+        if not isinstance(config.get('repos'), dict):
+            config['repos'] = {}
+        repos = []
+        if repo_file is not None:
+            repo_file.seek(0)
+            repos = [repo.rstrip() for repo in repo_file.readlines() if
+                    repo.rstrip() in config['repos']]
+        return (config, repos)
+
+    def _merge(self, config, repos):
+        """Apply the changes made through this instance since the tracking
+        files were last read or written onto `config` and `repos` (as
+        currently stored on disk) and return the merged `(config, repos)`."""
+        base_entries = self._base_config.get('repos') or {}
+        entries = self.config.get('repos') or {}
+        for name in base_entries:
+            if name not in entries:
+                config['repos'].pop(name, None)
+        for name, entry in entries.items():
+            if base_entries.get(name) != entry:
+                config['repos'][name] = entry
+        for key, value in self.config.items():
+            if key != 'repos' and self._base_config.get(key) != value:
+                config[key] = value
+
+        removed = [name for name in self._base_repos if name not in
+                self.repos]
+        added = [name for name in self.repos if name not in self._base_repos]
+        repos = [name for name in repos if name not in removed]
+        repos.extend([name for name in added if name not in repos])
+        return (config, [name for name in repos if name in config['repos']])
+
+    def _snapshot(self):
+        """Remember the state last read from or written to disk."""
+        self._base_config = copy.deepcopy(self.config)
+        self._base_repos = list(self.repos)
+
+    def _entry(self, name):
+        """Return the config entry of the controlled repository `name`."""
+        if not self.is_controlled_repo(name):
+            raise RepoError("'%s' is not a Mr. Repo controlled repository." %
+                    name)
+        return self.config['repos'][name]
+
+    def _batch(self, operation, items):
+        """Apply `operation` to every item, collecting a Result for each."""
+        results = []
+        for item in items:
+            self.counters.add('repos_scanned')
+            try:
+                results.append(operation(item))
+            except RepoError as error:
+                self.counters.add('failures')
+                results.append(Result(item, False, str(error)))
+        return results
+
+    def _parallel_batch(self, operation, items, jobs=None):
+        """Like _batch but applies `operation` to up to `jobs` items at
+        once."""
+        return maintenance.parallel_map(
+                lambda item: self._batch(operation, [item])[0], items, jobs)
+
+    @classmethod
+    def _head(cls, path):
+        """Return the `(sha, branch)` of the HEAD of the repository at `path`,
+        reading refs directly instead of asking git. `branch` is None when
+        detached and `sha` is None when there are no commits yet."""
+        try:
+            return gitmeta.RepoMetadata(path).head()
+        except gitmeta.UnsupportedLayout:
+            pass
+        repo = cls._git_repo(path)
+        try:
+            sha = git.refs.SymbolicReference.dereference_recursive(repo,
+                    'HEAD')
+        except ValueError:
+            return (None, None)
+        branch = None if repo.head.is_detached else repo.head.ref.name
+        return (sha, branch)
+
+    @classmethod
+    def _remote_url(cls, path):
+        """Return the URL of the `origin` remote of the repository at `path`
+        (or of another remote if there is no `origin`), None if it has no
+        remotes and raise RepoError if it is not a repository. Normal
+        repositories are read without spawning any processes."""
+        try:
+            return gitmeta.RepoMetadata(path).remote_url()
+        except gitmeta.UnsupportedLayout:
+            pass
+        rep = cls._git_repo(path)
+        remotes = dict([(remote.name, remote.url) for remote in rep.remotes])
+        if 'origin' in remotes:
+            return remotes['origin']
+        return remotes[sorted(remotes)[0]] if remotes else None
+
+    def _lock_path(self):
+        return os.path.join(self.path, self.lock_file_name)
+
+    def read_lock(self):
+        """Return the `{name: {'sha': ..., 'branch': ...}}` recorded in the
+        lockfile (empty if there is none). Raise MrRepoError if the lockfile
+        is not one written by `freeze`."""
+        if not os.path.isfile(self._lock_path()):
+            return {}
+        with open(self._lock_path()) as lock_file:
+            try:
+                lock = yaml.safe_load(lock_file) or {}
+            except yaml.YAMLError as error:
+                raise MrRepoError("%s is not valid YAML: %s" % (
+                    self.lock_file_name, error))
+        entries = (lock.get('repos') or {}) if isinstance(lock, dict) else \
+                None
+        if not isinstance(entries, dict) or not all([isinstance(entry, dict)
+                and entry.get('sha') for entry in entries.values()]):
+            raise MrRepoError("%s is not a Mr. Repo lockfile." %
+                    self.lock_file_name)
+        return entries
+
+    def _write_lock(self, entries):
+        # Every writer gets its own temporary file and renaming is atomic so
+        # readers never see a partial lockfile
+        (handle, temp_path) = tempfile.mkstemp(suffix='.tmp',
+                prefix=self.lock_file_name + '.', dir=self.path)
+        with os.fdopen(handle, 'w') as lock_file:
+            yaml.safe_dump({'repos': entries}, lock_file,
+                    default_flow_style=False)
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, self._lock_path())
+
+    @classmethod
+    def _get_repo(cls, apath):
+        try:
+            repo = git.Repo(apath)
+        except:
+            return None
+        return repo
+
+    @classmethod
+    def _git_repo(cls, apath):
+        """Return the git.Repo at `apath`, raising RepoError if there is
+        none."""
+        repo = cls._get_repo(apath)
+        if repo is None:
+            raise RepoError("%s is not a supported repository." % apath)
+        return repo
+
+    @classmethod
+    def is_repo(cls, apath):
+        """Return true if `apath` is a repository Mr. Repo can control. Only
+        layouts gitmeta cannot read are handed to GitPython."""
+        try:
+            git_dir = gitmeta.find_git_dir(apath)
+        except (gitmeta.UnsupportedLayout, IOError, OSError):
+            git_dir = None
+        else:
+            if git_dir is not None:
+                return os.path.isfile(os.path.join(git_dir, 'HEAD'))
+            if not gitmeta.is_bare(apath):
+                return False
+        return cls._get_repo(apath) is not None
+
+    @classmethod
+    def find_repos(cls, start_path, max_depth=4):
+        found_repos = []
+        if max_depth >= 0:
+            (base_path, directories, filenames) = next(os.walk(start_path,
+                    followlinks=True))
+            for directory in directories:
+                directory = os.path.join(start_path, directory)
+                if cls.is_repo(directory):
+                    found_repos.append(os.path.normpath(directory))
+                else:
+                    found_repos.extend(cls.find_repos(directory,
+                        max_depth - 1))
+        return found_repos
+
+    # Public functions
+
+    def load(self):
+        """Read `.mr_repo.yml` and `.this_repo` files to determine the state of
+        the repository."""
+        if os.path.isfile(self.config_path):
+            with self._open() as files:
+                (self.config, self.repos) = self._read_files(*files)
+        else:
+            (self.config, self.repos) = ({'repos': {}}, [])
+        self._snapshot()
+        return self
+
+    def save(self, merge=True):
+        """Write the tracking files, merging in concurrent changes unless
+        `merge` is false."""
+        with self._open(exclusive=True) as (config_file, repo_file):
+            if merge:
+                (self.config, self.repos) = self._merge(
+                        *self._read_files(config_file, repo_file))
+
+            # Delete contents of files
+            config_file.seek(0)
+            config_file.truncate()
+            repo_file.seek(0)
+            repo_file.truncate()
+
+            # Write contents to files
+            yaml.dump(self.config, config_file)
+            repo_file.write('\n'.join(self.repos))
+            if len(self.repos) > 0:
+                repo_file.write('\n')
+            config_file.flush()
+            repo_file.flush()
+            self.write_completion_index()
+        self._snapshot()
+
+    def write_completion_index(self):
+        """Write the plain text index of repository names read by the shell
+        completion scripts (see mr_repo.completion)."""
+        if self.completion_file_name:
+            completion.write_index(os.path.join(self.path,
+                self.completion_file_name), self.config['repos'].keys(),
+                self.repos)
+
+    def is_controlled_repo(self, repo_str):
+        """Return true if repo_str is a Mr. Repo controlled repo."""
+        return repo_str in self.config.get('repos').keys()
+
+    def check_repo_name(self, name):
+        repo_name = os.path.basename(os.path.normpath(name))
+        if self.is_controlled_repo(repo_name):
+            return repo_name
+        else:
+            return False
+
+    # Mr. Repo operations
+
+    def init(self, clean=False):
+        """Create fresh tracking files, populated from the repositories found
+        in the directory unless `clean` is true."""
+        self.config = {'repos': {}}
+        self.repos = []
+        if not clean:
+            self._batch(self._add, self.find_repos(self.path))
+        self.save(merge=False)
+        return Result(self.path, True,
+                "Successfully initialized Mr. Repo at '%s'." % self.path)
+
+    def _add(self, path):
+        # Path relative to CWD
+        cur_rel_path = os.path.normpath(path)
+        # Path relative to Mr. Repo directory
+        mr_rel_path = os.path.relpath(cur_rel_path, self.path)
+        repo_name = os.path.basename(mr_rel_path)
+
+        if self.is_controlled_repo(repo_name):
+            raise RepoError("%s is already controlled by Mr. Repo (i.e it is "
+                    "in %s)." % (repo_name, self.config_file_name))
+        remote = self._remote_url(cur_rel_path)
+
+        self.repos.append(repo_name)
+        if remote is not None:
+            repo_dict = {repo_name: {'type': 'Git',
+                'remote': remote, 'path': mr_rel_path}}
+        else:
+            repo_dict = {repo_name: {'type': 'Git', 'path': mr_rel_path}}
+        log.debug("Adding to config: " + str(repo_dict))
+        self.config.get('repos').update(repo_dict)
+        return Result(repo_name, True,
+                "Successfully added '%s' to Mr. Repo." % repo_name)
+
+    def add(self, paths):
+        """Put the local repositories at `paths` under Mr. Repo control."""
+        results = self._batch(self._add, paths)
+        if any([result.ok for result in results]):
+            self.save()
+        return results
+
+    def _rm(self, name):
+        name = os.path.basename(os.path.normpath(name))
+        self._entry(name)
+        self.config['repos'].pop(name)
+        if name in self.repos:
+            self.repos.remove(name)
+        return Result(name, True,
+                "Successfully removed '%s' from Mr. Repo control." % name)
+
+    def rm(self, names):
+        """Remove repositories from Mr. Repo control. Nothing is removed from
+        the filesystem (use `unget` for that)."""
+        results = self._batch(self._rm, names)
+        if any([result.ok for result in results]):
+            self.save()
+        return results
+
+    def _get(self, name):
+        name = os.path.basename(os.path.normpath(name))
+        entry = self._entry(name)
+        if 'remote' not in entry:
+            raise RepoError("%s does not have an associated remote to "
+                    "repossess it from." % name)
+        if entry['type'] != 'Git':
+            raise RepoError("Repositories of type '%s' are not supported" %
+                    entry['type'])
+        patterns = self._sparse_patterns(name)
+        try:
+            if patterns is None:
+                new_repo = git.Repo.clone_from(entry['remote'],
+                        self._repo_path(name))
+            else:
+                # Only check out the files matching the sparse patterns
+                new_repo = git.Repo.clone_from(entry['remote'],
+                        self._repo_path(name), no_checkout=True)
+                self._apply_sparse(new_repo, patterns)
+        except git.exc.GitCommandError as error:
+            raise RepoError("Could not clone '%s': %s" % (name, error))
+        # Only the (freshly packed) object store was transferred, so this is
+        # cheap even for checkouts with many files
+        self.counters.add('bytes_cloned', maintenance.disk_usage(
+            os.path.join(new_repo.git_dir, 'objects'))[0])
+        self.repos.append(name)
+        return Result(name, True, "Successfully cloned '%s' into '%s'." %
+                (name, new_repo.working_dir))
+
+    def _sparse_patterns(self, name, profile=None):
+        """Return the sparse checkout patterns of `profile` (by default the
+        profile selected in the config entry) of the repository `name`, or
+        None for a full checkout.
+
+        The `sparse` key of an entry is either a list of patterns or the name
+        of one of the lists in its `sparse_profiles`. The profile `full`
+        always means a full checkout."""
+        entry = self._entry(name)
+        if profile is None:
+            profile = entry.get('sparse')
+        if profile is None or profile == 'full':
+            return None
+        if isinstance(profile, list):
+            return profile
+        profiles = entry.get('sparse_profiles') or {}
+        if profile not in profiles:
+            raise RepoError("'%s' does not have a sparse checkout profile "
+                    "called '%s'." % (name, profile))
+        return profiles[profile]
+
+    @classmethod
+    def _apply_sparse(cls, repo, patterns):
+        """Reshape the working tree of `repo` to only contain the files
+        matching `patterns` (everything if None). This uses
+        `core.sparseCheckout` and `read-tree` which every git version
+        supports."""
+        sparse_path = os.path.join(repo.git_dir, 'info', 'sparse-checkout')
+        if not os.path.isdir(os.path.dirname(sparse_path)):
+            os.makedirs(os.path.dirname(sparse_path))
+        with open(sparse_path, 'w') as sparse_file:
+            sparse_file.write('\n'.join(patterns or ['/*']) + '\n')
+        repo.git.config('core.sparseCheckout', 'true')
+        if cls._head(repo.working_dir)[0] is not None:
+            repo.git.read_tree('-mu', 'HEAD')
+        if patterns is None:
+            repo.git.config('core.sparseCheckout', 'false')
+
+    def _sparse(self, name, profile, patterns=None, force=False):
+        entry = self._entry(name)
+        if patterns and profile == 'full':
+            raise RepoError("The 'full' sparse checkout profile always checks "
+                    "out everything and cannot be given patterns.")
+        # Only change the config entry once the checkout has been reshaped
+        selected = list(patterns) if patterns else \
+                self._sparse_patterns(name, profile)
+        if name in self.repos:
+            if not os.path.isdir(self._repo_path(name)):
+                raise RepoError("'%s' is missing from '%s'." % (name,
+                    self._repo_path(name)))
+            repo = self._git_repo(self._repo_path(name))
+            # Modified files are left in the working tree by read-tree, so
+            # make sure there are none unless we are forcing it
+            if not force and repo.is_dirty():
+                raise RepoError("'%s' is dirty. Fix it or use the `--force` "
+                        "option to reshape it anyway." % name)
+            try:
+                self._apply_sparse(repo, selected)
+            except git.exc.GitCommandError as error:
+                raise RepoError("Could not reshape '%s': %s" % (name, error))
+        if patterns:
+            entry.setdefault('sparse_profiles', {})[profile] = selected
+        if profile == 'full':
+            entry.pop('sparse', None)
+        else:
+            entry['sparse'] = profile
+        return Result(name, True, "Successfully switched '%s' to the '%s' "
+                "sparse checkout profile." % (name, profile))
+
+    def sparse(self, name, profile, patterns=None, force=False):
+        """
+        Select the sparse checkout `profile` of the repository `name` (`full`
+        to check out everything), optionally (re)defining it as `patterns`.
+
+        The selection is saved in the repository's config entry and used by
+        later `get`s. If the repository is available its working tree is
+        reshaped right away, which is refused if it has uncommitted changes
+        unless `force` is true.
+        """
+        results = self._batch(lambda name: self._sparse(name, profile,
+            patterns, force), [name])
+        if results[0].ok:
+            self.save()
+        return results[0]
+
+    def get(self, names):
+        """Clone controlled repositories which are not available locally.
+        Repositories with a sparse checkout profile selected only get the
+        files matching it checked out."""
+        results = []
+        try:
+            results = self._batch(self._get, names)
+        finally:
+            if self.repos != self._base_repos:
+                self.save()
+        return results
+
+    def _unget(self, name, force=False):
+        name = os.path.basename(os.path.normpath(name))
+        if name not in self.repos or not self.is_controlled_repo(name):
+            raise RepoError("'%s' is not a currently checked out Mr. Repo "
+                    "controlled repository." % name)
+        entry = self._entry(name)
+        if entry['type'] != 'Git':
+            raise RepoError("Repositories of type '%s' are not supported " %
+                    entry['type'])
+        repo_path = self._repo_path(name)
+        # If we aren't forcing removal make sure it isn't dirty
+        if not force and git.Repo(repo_path).is_dirty():
+            raise RepoError("'%s' is dirty. Fix it or use the `--force` "
+                    "option to force it's removal." % name)
+        # Everything is ok. So we now do the removing
+        shutil.rmtree(repo_path)
+        self.repos.remove(name)
+        return Result(name, True,
+                "Successfully removed the local copy of '%s'." % name)
+
+    def unget(self, names, force=False):
+        """Remove controlled repositories from the local system."""
+        results = []
+        try:
+            results = self._batch(lambda name: self._unget(name, force),
+                    names)
+        finally:
+            if self.repos != self._base_repos:
+                self.save()
+        return results
+
+    def list(self, which='available'):
+        """Return a dict of the config entries of the `available`,
+        `unavailable` or `all` controlled repositories."""
+        repos = self.config['repos']
+        if which == 'unavailable':
+            # Unavailable means it is in the config, but not in self.repos.
+            return dict([x for x in repos.items() if x[0] not in self.repos])
+        elif which == 'available':
+            return dict([x for x in repos.items() if x[0] in self.repos])
+        elif which == 'all':
+            return dict(repos)
+        raise ValueError("which must be 'available', 'unavailable' or 'all'")
+
+    def update(self, path=None):
+        """Put every repository found under `path` (the Mr. Repo directory by
+        default) which is not yet controlled under Mr. Repo control."""
+        paths = [found for found in self.find_repos(path or self.path) if
+                not self.is_controlled_repo(os.path.basename(found))]
+        return self.add(paths)
+
+    def du(self, jobs=None, use_cache=True):
+        """
+        Return a list of `(name, total, git)` tuples with the bytes used on
+        disk by every available repository (and its `.git` directory), largest
+        first.
+
+        Repositories are measured in parallel. Sizes are cached in
+        `.mr_repo_du.yml` and only recomputed for repositories in which a file
+        or directory has been created, deleted or renamed since they were last
+        measured. Checking that still walks every directory, so a cache hit
+        is cheaper than measuring but not free (see maintenance.usage_stamp).
+        """
+        cache = maintenance.UsageCache(os.path.join(self.path,
+                self.du_cache_file_name))
+        names = [name for name in self.repos if
+                os.path.isdir(self._repo_path(name))]
+
+        def measure(name):
+            self.counters.add('repos_scanned')
+            path = self._repo_path(name)
+            stamp = maintenance.usage_stamp(path)
+            usage = cache.get(name, stamp) if use_cache else None
+            if usage is None:
+                log.debug("Measuring disk usage of " + path)
+                usage = maintenance.disk_usage(path)
+            return (name, stamp, usage)
+
+        measured = maintenance.parallel_map(measure, names, jobs)
+        for name, stamp, usage in measured:
+            cache.put(name, stamp, usage)
+        cache.prune(names)
+        cache.save()
+
+        usages = [(name, usage[0], usage[1]) for name, stamp, usage in
+                measured]
+        usages.sort(key=lambda x: x[1], reverse=True)
+        return usages
+
+    def gc(self, names=None, jobs=None, niceness=10, ionice='best-effort',
+            aggressive=False):
+        """
+        Run `git gc` over the available repositories (or just `names`).
+
+        At most `jobs` repositories are collected at once and each `git gc`
+        runs under `nice` and `ionice` (when they are installed) so that
+        maintenance can happen without starving other work on the machine.
+        """
+        names = names or list(self.repos)
+        command = maintenance.gc_command_line(aggressive=aggressive,
+                niceness=niceness, ionice_class=ionice)
+        log.debug("Running: " + ' '.join(command))
+
+        def collect(name):
+            self.counters.add('repos_scanned')
+            if name not in self.repos:
+                self.counters.add('failures')
+                return Result(name, False, "'%s' is not a currently checked "
+                        "out Mr. Repo controlled repository." % name)
+            if not os.path.isdir(self._repo_path(name)):
+                self.counters.add('failures')
+                return Result(name, False, "'%s' is missing from '%s'." % (
+                    name, self._repo_path(name)))
+            self.counters.add('git_subprocesses')
+            returncode, output = maintenance.run_gc(self._repo_path(name),
+                    command)
+            if returncode != 0:
+                self.counters.add('failures')
+                return Result(name, False, "`git gc` failed in '%s': %s" %
+                        (name, output))
+            return Result(name, True, "Successfully collected '%s'." % name)
+
+        return maintenance.parallel_map(collect, names, jobs)
+
+    def _freeze(self, name):
+        if name not in self.repos or not self.is_controlled_repo(name):
+            raise RepoError("'%s' is not a currently checked out Mr. Repo "
+                    "controlled repository." % name)
+        if not os.path.isdir(self._repo_path(name)):
+            raise RepoError("'%s' is missing from '%s'." % (name,
+                self._repo_path(name)))
+        (sha, branch) = self._head(self._repo_path(name))
+        if sha is None:
+            raise RepoError("'%s' does not have any commits to freeze." %
+                    name)
+        return Result(name, True, "Froze '%s' at %s (%s)." % (name, sha[:12],
+            branch or 'detached'), {'sha': sha, 'branch': branch})
+
+    def freeze(self, names=None, jobs=None):
+        """
+        Record the HEAD commit and branch of the available repositories (or
+        just `names`) in the lockfile (`.mr_repo_lock.yml`).
+
+        Repositories are read in parallel. Freezing every repository replaces
+        the lockfile while freezing only some updates their entries. The
+        data of each successful Result is the recorded `{'sha', 'branch'}`
+        entry.
+        """
+        results = self._parallel_batch(self._freeze, names or
+                list(self.repos), jobs)
+        # Hold the tracking files' lock so concurrent partial freezes do not
+        # lose each other's entries
+        with self._open(exclusive=True):
+            entries = self.read_lock() if names else {}
+            for result in results:
+                if result.ok:
+                    entries[result.name] = result.data
+            self._write_lock(entries)
+        return results
+
+    def _restore(self, name, sha, branch=None, force=False):
+        entry = self._entry(name)
+        if entry['type'] != 'Git':
+            raise RepoError("Repositories of type '%s' are not supported" %
+                    entry['type'])
+        cloned = False
+        if not os.path.isdir(self._repo_path(name)):
+            if name in self.repos:
+                self.repos.remove(name)
+            self._get(name)
+            cloned = True
+        repo = self._git_repo(self._repo_path(name))
+        if name not in self.repos:
+            self.repos.append(name)
+
+        # Cheap check: compare refs without spawning git (a fresh clone is
+        # always reported as cloned)
+        if not cloned and self._head(self._repo_path(name))[0] == sha:
+            return Result(name, True, "'%s' is already at %s." % (name,
+                sha[:12]))
+        if not (force or cloned) and repo.is_dirty():
+            raise RepoError("'%s' is dirty. Fix it or use the `--force` "
+                    "option to restore it anyway." % name)
+        try:
+            try:
+                repo.git.cat_file('-e', sha + '^{commit}')
+            except git.exc.GitCommandError:
+                log.debug("Fetching %s to find %s" % (name, sha))
+                repo.git.fetch('--all')
+            local_branches = dict([(head.name, head) for head in repo.heads])
+            if branch and branch in local_branches:
+                if local_branches[branch].commit.hexsha == sha:
+                    repo.git.checkout(branch)
+                else:
+                    # Never move an existing branch; detach instead.
+                    repo.git.checkout(sha)
+            elif branch:
+                repo.git.checkout('-b', branch, sha)
+            else:
+                repo.git.checkout(sha)
+        except git.exc.GitCommandError as error:
+            raise RepoError("Could not restore '%s' to %s: %s" % (name,
+                sha[:12], error))
+        return Result(name, True, "Successfully %s '%s' at %s." % (
+            'cloned and restored' if cloned else 'restored', name, sha[:12]))
+
+    def restore(self, names=None, jobs=None, force=False):
+        """
+        Check out the commits recorded in the lockfile, cloning repositories
+        which are not available. Repositories are restored in parallel and
+        those already at the recorded commit are skipped after a cheap ref
+        comparison.
+        """
+        entries = self.read_lock()
+        names = names or sorted(entries.keys())
+
+        def restore_one(name):
+            if name not in entries:
+                raise RepoError("'%s' is not in %s." % (name,
+                    self.lock_file_name))
+            return self._restore(name, entries[name]['sha'],
+                    entries[name].get('branch'), force)
+
+        results = []
+        try:
+            results = self._parallel_batch(restore_one, names, jobs)
+        finally:
+            if self.repos != self._base_repos:
+                self.save()
+        return results
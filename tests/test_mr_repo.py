@@ -14,7 +14,14 @@ sys.path.insert(0, os.path.abspath('..'))
 
 from pea import step, TestCase, Given, When, Then, And, world
 from mr_repo.repossesser import Repossesser
+from mr_repo.workspace import Workspace, NotAWorkspaceError
+from mr_repo import metrics
+from mr_repo import gitmeta
+from mr_repo import maintenance
+from multiprocessing.pool import ThreadPool
 import git
+import subprocess
+import yaml
 import tempfile
 import copy
 import shutil
@@ -63,6 +70,52 @@ def I_have_a_git_repository_called(repo_name, bare=False):
     world.repos.append(git.Repo.init(repo_dir, bare=bare))
 
 
+@step
+def I_have_remote_repositories(count, prefix='remote_', commits=0):
+    """Create `count` repositories outside of the Mr. Repo repository and
+    register them in its config without making them available."""
+    remote_dir = tempfile.mkdtemp(prefix="tmpmrrepotestingremotes")
+    world.extra_dirs.append(remote_dir)
+    world.remotes = {}
+    for index in range(count):
+        name = prefix + str(index)
+        world.remotes[name] = git.Repo.init(os.path.join(remote_dir, name))
+        for commit in range(commits):
+            I_commit_to(world.remotes[name])
+        world.mr_repo.config['repos'][name] = {'type': 'Git',
+                'remote': os.path.join(remote_dir, name), 'path': name}
+    world.mr_repo.write_config()
+    world.mr_repo.close()
+
+
+@step
+def I_commit_to(repo):
+    """Make a new (empty) commit in `repo` and return its sha."""
+    return repo.index.commit("Commit").hexsha
+
+
+@step
+def I_commit_files_to(repo, paths):
+    """Create the files at `paths` (relative to `repo`) and commit them."""
+    for path in paths:
+        full_path = os.path.join(repo.working_dir, path)
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        with open(full_path, 'w') as new_file:
+            new_file.write(path)
+    repo.index.add(paths)
+    return repo.index.commit("Add files").hexsha
+
+
+@step
+def I_write_a_file(path, size):
+    """Write `size` bytes to `path`, creating its directory if needed."""
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as new_file:
+        new_file.write(b'x' * size)
+
+
 @step
 def I_have_a_nested_structure(levels, prefix='level_'):
     current_dir = world.tdir
@@ -92,6 +145,7 @@ def I_execute_the_command(close=True):
     if close:
         world.mr_repo.close()
     world.assertIsInstance(result, str)
+    world.result = result
 
 
 @step
@@ -108,6 +162,32 @@ def I_execute_the_following_input(given_input):
     I_execute_all_of_the_input()
 
 
+@step
+def I_run_the_following_input_concurrently(given_input):
+    """Run every line of input as its own Mr. Repo invocation, all at once."""
+    def run(line):
+        Repossesser(args=line.split() + ['-d', world.tdir], execute=True,
+                quiet=True, one_use=True)
+    pool = ThreadPool(len(given_input))
+    try:
+        pool.map(run, given_input)
+    finally:
+        pool.close()
+        pool.join()
+
+
+@step
+def I_add_through_a_workspace(paths):
+    world.results = Workspace(world.tdir).load().add(paths)
+
+
+@step
+def I_add_through_a_workspace_counting_git_processes(paths):
+    world.counters = metrics.Counters()
+    with metrics.counting_git_subprocesses(world.counters):
+        I_add_through_a_workspace(paths)
+
+
 @step
 def I_add_the_repository(repo_path):
     world.mr_repo.args.command = 'add'
@@ -142,6 +222,98 @@ def I_have_Mr_Repo_config_files():
     world.assertIsInstance(world.mr_repo.repos, list)
 
 
+@step
+def the_last_result_matches(pattern):
+    world.assertRegexpMatches(world.result, pattern)
+
+
+@step
+def the_du_cache_contains(repo_name):
+    with open(os.path.join(world.tdir, '.mr_repo_du.yml')) as cache_file:
+        world.assertIn(repo_name, yaml.safe_load(cache_file))
+
+
+@step
+def the_workspace_results_are(oks):
+    world.assertListEqual([result.ok for result in world.results], oks)
+
+
+@step
+def the_repository_is_at(path, sha):
+    world.assertEqual(git.Repo(path).head.commit.hexsha, sha)
+
+
+@step
+def the_last_metrics_record_has(**expected):
+    record = metrics.read(os.path.join(world.tdir,
+        '.mr_repo_metrics.log'))[-1]
+    for field, value in expected.items():
+        if callable(value):
+            assert value(record[field]), "Unexpected %s: %r" % (field,
+                    record[field])
+        else:
+            world.assertEqual(record[field], value)
+
+
+@step
+def no_git_processes_were_spawned():
+    world.assertEqual(world.counters.values['git_subprocesses'], 0)
+
+
+@step
+def the_config_has_remote(repo_name, remote):
+    mr_repo = Repossesser(args=['list', '-d', world.tdir], one_use=True)
+    world.assertEqual(mr_repo.config['repos'][repo_name].get('remote'),
+            remote)
+
+
+@step
+def the_completion_index_is(lines):
+    with open(os.path.join(world.tdir, '.mr_repo_complete')) as index_file:
+        world.assertListEqual(index_file.read().splitlines(), lines)
+
+
+@step
+def bash_completes(line, words):
+    """Run the generated bash completion for `line` (completing its last
+    word) and compare the completions to `words`."""
+    script_path = os.path.join(world.tdir, 'mr_repo.bash')
+    with open(script_path, 'w') as script_file:
+        script_file.write(world.result)
+    command = ('source "$0"; COMP_WORDS=(%s); '
+            'COMP_CWORD=$((${#COMP_WORDS[@]} - 1)); _mr_repo; '
+            'echo "${COMPREPLY[*]}"') % line
+    output = subprocess.check_output(['bash', '-c', command, script_path],
+            cwd=world.tdir)
+    world.assertItemsEqual(output.split(), words)
+
+
+@step
+def the_checkout_contains(path, files):
+    found = []
+    for base, directories, filenames in os.walk(path):
+        if '.git' in directories:
+            directories.remove('.git')
+        found.extend([os.path.relpath(os.path.join(base, filename), path)
+            for filename in filenames])
+    world.assertItemsEqual(found, files)
+
+
+@step
+def a_refused_sparse_call_leaves_the_config_alone(name):
+    workspace = Workspace(world.tdir).load()
+    entry = copy.deepcopy(workspace.config['repos'][name])
+    world.assertFalse(workspace.sparse(name, 'docs', ['/docs/']).ok)
+    world.assertDictEqual(workspace.config['repos'][name], entry)
+
+
+@step
+def I_have_these_available_repos(names):
+    mr_repo = Repossesser(args=['list', '-d', world.tdir], one_use=True)
+    world.assertItemsEqual(mr_repo.config['repos'].keys(), names)
+    world.assertItemsEqual(mr_repo.repos, names)
+
+
 @step
 def I_have_updated_config_files(config_check=world.assertNotEqual,
         repo_check=world.assertNotEqual):
@@ -163,6 +335,7 @@ class RepossesserStories(TestCase):
         world.mr_repo = Repossesser()
         world.states = [clone_state(world.mr_repo)]
         world.repos = []
+        world.extra_dirs = []
 
     def tearDown(self):
         super(RepossesserStories, self).tearDown()
@@ -178,6 +351,10 @@ class RepossesserStories(TestCase):
                 if os.path.exists(repo.working_dir):
                     shutil.rmtree(repo.working_dir)
 
+        for extra_dir in world.extra_dirs:
+            if os.path.exists(extra_dir):
+                shutil.rmtree(extra_dir)
+
         # Make sure the test directory is gone
         if hasattr(world, 'tdir'):
             if os.path.exists(world.tdir):
@@ -246,4 +423,306 @@ class RepossesserStories(TestCase):
     def test_update_stops_searching_at_max_level(self):
         pass
 
+    def test_du_reports_and_caches_available_repos(self):
+        """Running du lists every available repo and caches the sizes."""
+        repo_name = "Hats"
+        Given.I_have_a_git_repository_called(repo_name)
+        And.I_create_a_Mr_Repo_repository()
+        When.I_execute_the_following_input("du")
+        Then.the_last_result_matches("^Hats +- .*\ntotal +- ")
+        And.the_du_cache_contains(repo_name)
+
+    def test_du_notices_nested_changes(self):
+        """Cached sizes are recomputed when a nested file is written."""
+        repo_name = "Caps"
+        Given.I_have_a_git_repository_called(repo_name)
+        nested_dir = os.path.join(world.repos[0].working_dir, 'sub')
+        And.I_write_a_file(os.path.join(nested_dir, 'small'), 1)
+        And.I_create_a_Mr_Repo_repository()
+        When.I_execute_the_following_input("du")
+        Then.the_last_result_matches("^Caps +- [0-9.]+K ")
+        When.I_write_a_file(os.path.join(nested_dir, 'big'), 2 * 1024 * 1024)
+        And.I_execute_the_following_input("du")
+        Then.the_last_result_matches("^Caps +- 2\\.[0-9]M ")
+
+    def test_du_ignores_a_corrupt_cache(self):
+        """A cache file which is not valid YAML is ignored and replaced."""
+        Given.I_have_a_git_repository_called("Berets")
+        And.I_create_a_Mr_Repo_repository()
+        with open(os.path.join(world.tdir, '.mr_repo_du.yml'), 'w') as cache:
+            cache.write("Berets: {stamp: [1, 2\n")
+        When.I_execute_the_following_input("du")
+        Then.the_last_result_matches("^Berets +- ")
+        And.the_du_cache_contains("Berets")
+
+    def test_gc_collects_available_repos(self):
+        """Running gc succeeds on every available repo."""
+        Given.I_have_a_git_repository_called("Gloves")
+        And.I_have_a_git_repository_called("Scarves")
+        And.I_create_a_Mr_Repo_repository()
+        When.I_execute_the_following_input("gc -j 2")
+        Then.the_last_result_matches("^Successfully collected 2 ")
+
+    def test_gc_reports_missing_repos(self):
+        """Running gc reports repos whose directory has been deleted."""
+        Given.I_have_a_git_repository_called("Mittens")
+        And.I_create_a_Mr_Repo_repository()
+        shutil.rmtree(world.repos[0].working_dir)
+        When.I_execute_the_following_input("gc")
+        Then.the_last_result_matches("^ERROR: 'Mittens' is missing ")
+
+    def test_concurrent_adds_and_gets_are_all_kept(self):
+        """Running many adds and gets at once loses no tracking entries."""
+        count = 32
+        local_names = ['local_' + str(index) for index in range(count)]
+        remote_names = ['remote_' + str(index) for index in range(count)]
+        Given.I_create_a_Mr_Repo_repository(clean=True)
+        And.I_have_remote_repositories(count)
+        for name in local_names:
+            And.I_have_a_git_repository_called(name)
+        When.I_run_the_following_input_concurrently(
+                ['add ' + os.path.join(world.tdir, name) for name in
+                    local_names] +
+                ['get ' + name for name in remote_names])
+        Then.I_have_these_available_repos(local_names + remote_names)
+
+    def test_workspace_adds_batches(self):
+        """A Workspace adds several repos at once and reports each result."""
+        Given.I_have_a_git_repository_called("Boots")
+        And.I_have_a_git_repository_called("Sandals")
+        And.I_create_a_Mr_Repo_repository(clean=True)
+        When.I_add_through_a_workspace([repo.working_dir for repo in
+            world.repos] + [world.tdir])
+        Then.the_workspace_results_are([True, True, False])
+        And.I_have_these_available_repos(["Boots", "Sandals"])
+
+    def test_workspace_requires_a_Mr_Repo_repository(self):
+        """Opening a Workspace on an uninitialized directory fails."""
+        world.assertRaises(NotAWorkspaceError, Workspace, world.tdir)
+
+    def test_restore_checks_out_frozen_commits(self):
+        """Restoring after a freeze goes back to the frozen commit."""
+        Given.I_have_a_git_repository_called("Pants")
+        frozen_sha = And.I_commit_to(world.repos[0])
+        And.I_create_a_Mr_Repo_repository()
+        When.I_execute_the_following_input("freeze")
+        And.I_commit_to(world.repos[0])
+        And.I_execute_the_following_input("restore")
+        Then.the_last_result_matches("^Successfully restored 'Pants' ")
+        And.the_repository_is_at(world.repos[0].working_dir, frozen_sha)
+        When.I_execute_the_following_input("restore")
+        Then.the_last_result_matches("^'Pants' is already at ")
+
+    def test_freeze_and_restore_report_broken_repos(self):
+        """Freezing and restoring report repos which were deleted or are no
+        longer repositories instead of aborting."""
+        Given.I_have_a_git_repository_called("Socks")
+        And.I_have_a_git_repository_called("Shorts")
+        for repo in world.repos:
+            And.I_commit_to(repo)
+        And.I_create_a_Mr_Repo_repository()
+        shutil.rmtree(world.repos[0].working_dir)
+        When.I_execute_the_following_input("freeze")
+        Then.the_last_result_matches("ERROR: 'Socks' is missing from ")
+        And.the_last_result_matches("Froze 'Shorts' at ")
+        shutil.rmtree(os.path.join(world.repos[1].working_dir, '.git'))
+        When.I_execute_the_following_input("restore Shorts")
+        Then.the_last_result_matches("^ERROR: .* is not a supported "
+                "repository")
+
+    def test_concurrent_freezes_are_all_kept(self):
+        """Freezing repos one by one at the same time loses no entries."""
+        names = ['frozen_' + str(index) for index in range(16)]
+        for name in names:
+            Given.I_have_a_git_repository_called(name)
+            And.I_commit_to(world.repos[-1])
+        And.I_create_a_Mr_Repo_repository()
+        When.I_run_the_following_input_concurrently(['freeze ' + name for
+            name in names])
+        world.assertItemsEqual(Workspace(world.tdir).read_lock().keys(),
+                names)
+
+    def test_restore_rejects_a_malformed_lockfile(self):
+        """Restoring from a lockfile not written by freeze is an error."""
+        Given.I_create_a_Mr_Repo_repository(clean=True)
+        with open(os.path.join(world.tdir, '.mr_repo_lock.yml'), 'w') as lock:
+            lock.write("just a string\n")
+        When.I_execute_the_following_input("restore")
+        Then.the_last_result_matches("^ERROR: .* is not a Mr. Repo lockfile")
+
+    def test_workspace_freezes_into_result_data(self):
+        """Freezing through a Workspace keeps messages readable and returns
+        the recorded commit as data."""
+        Given.I_have_a_git_repository_called("Vests")
+        sha = And.I_commit_to(world.repos[0])
+        branch = world.repos[0].active_branch.name
+        And.I_create_a_Mr_Repo_repository()
+        results = Workspace(world.tdir).load().freeze()
+        world.assertEqual(results[0].message, "Froze 'Vests' at %s (%s)." % (
+            sha[:12], branch))
+        world.assertDictEqual(results[0].data, {'sha': sha,
+            'branch': branch})
+
+    def test_restore_clones_missing_repositories(self):
+        """Restoring clones unavailable repos at their frozen commit."""
+        Given.I_create_a_Mr_Repo_repository(clean=True)
+        And.I_have_remote_repositories(1, commits=1)
+        And.I_execute_the_following_input(["get remote_0", "freeze",
+            "unget remote_0"])
+        frozen_sha = world.remotes['remote_0'].head.commit.hexsha
+        When.I_commit_to(world.remotes['remote_0'])
+        And.I_execute_the_following_input("restore")
+        Then.the_last_result_matches("^Successfully cloned and restored ")
+        And.the_repository_is_at(os.path.join(world.tdir, 'remote_0'),
+                frozen_sha)
+        And.I_have_these_available_repos(['remote_0'])
+
+    def test_restore_reports_clones_at_the_frozen_commit(self):
+        """Restoring an unavailable repo whose remote has not moved still
+        reports that it was cloned."""
+        Given.I_create_a_Mr_Repo_repository(clean=True)
+        And.I_have_remote_repositories(1, commits=1)
+        When.I_execute_the_following_input(["get remote_0", "freeze",
+            "unget remote_0", "restore remote_0"])
+        Then.the_last_result_matches("^Successfully cloned and restored "
+                "'remote_0' at ")
+        And.I_have_these_available_repos(['remote_0'])
+
+    def test_commands_record_metrics(self):
+        """Commands append metrics which stats summarises."""
+        Given.I_create_a_Mr_Repo_repository(clean=True)
+        And.I_have_remote_repositories(1, commits=1)
+        When.I_execute_the_following_input("get remote_0 missing")
+        Then.the_last_metrics_record_has(command='get', repos_scanned=2,
+                failures=1, bytes_cloned=lambda x: x > 0,
+                git_subprocesses=lambda x: x > 0)
+        When.I_execute_the_following_input("stats")
+        Then.the_last_result_matches("\nget +1 ")
+
+    def test_metrics_export_for_prometheus(self):
+        """Metrics can be exported for the Prometheus textfile collector."""
+        textfile = os.path.join(world.tdir, 'mr_repo.prom')
+        Given.I_create_a_Mr_Repo_repository(clean=True)
+        When.I_execute_the_following_input("list --prometheus-textfile " +
+                textfile)
+        with open(textfile) as prom_file:
+            world.assertRegexpMatches(prom_file.read(),
+                    'mr_repo_recorded_runs{command="list",.*} 1\n')
+
+    def test_metrics_file_rotates(self):
+        """The metrics file is rotated once it grows too large."""
+        path = os.path.join(world.tdir, 'metrics.log')
+        for index in range(10):
+            metrics.append(path, {'command': 'list', 'duration': index},
+                    max_bytes=100, backups=2)
+        world.assertTrue(os.path.isfile(path + '.2'))
+        world.assertFalse(os.path.isfile(path + '.3'))
+        world.assertListEqual([record['duration'] for record in
+            metrics.read(path, backups=2)][-1:], [9])
+
+    def test_adding_reads_metadata_without_git(self):
+        """Adding normal repos reads their remotes without running git."""
+        Given.I_have_a_git_repository_called("Ties")
+        And.I_have_a_git_repository_called("Belts")
+        world.repos[0].create_remote('origin', 'git://example.com/ties')
+        world.repos[1].create_remote('upstream', 'git://example.com/belts')
+        And.I_create_a_Mr_Repo_repository(clean=True)
+        When.I_add_through_a_workspace_counting_git_processes(
+                [repo.working_dir for repo in world.repos])
+        Then.no_git_processes_were_spawned()
+        And.the_config_has_remote("Ties", 'git://example.com/ties')
+        And.the_config_has_remote("Belts", 'git://example.com/belts')
+
+    def test_metadata_of_worktrees(self):
+        """Worktrees are read through their `.git` file and common dir."""
+        Given.I_have_a_git_repository_called("Coats")
+        world.repos[0].create_remote('origin', 'git://example.com/coats')
+        sha = And.I_commit_to(world.repos[0])
+        worktree = os.path.join(world.tdir, 'Jackets')
+        world.repos[0].git.worktree('add', '-b', 'jackets', worktree)
+        metadata = gitmeta.RepoMetadata(worktree)
+        world.assertEqual(metadata.remote_url(), 'git://example.com/coats')
+        world.assertEqual(metadata.head(), (sha, 'jackets'))
+
+    def test_parsing_git_config(self):
+        """Quoted values, comments and old style sections are parsed."""
+        config = gitmeta.parse_config('# comment\n[remote "origin"]\n'
+                '\turl = "git://example.com/a b" ; comment\n'
+                '[Core]\n\tBare\n[branch.master]\n\tremote = origin\n')
+        world.assertEqual(config[('remote', 'origin')]['url'],
+                ['git://example.com/a b'])
+        world.assertEqual(config[('core', None)]['bare'], ['true'])
+        world.assertEqual(config[('branch', 'master')]['remote'],
+                ['origin'])
+        world.assertRaises(gitmeta.UnsupportedLayout, gitmeta.parse_config,
+                '[include]\n\tpath = other\n')
+
+    def test_completion_of_repository_names(self):
+        """The completion index tracks the repos the scripts complete."""
+        Given.I_have_a_git_repository_called("Shirts")
+        And.I_create_a_Mr_Repo_repository(clean=True)
+        And.I_have_remote_repositories(1)
+        When.I_execute_the_following_input(["add " +
+            world.repos[0].working_dir, "completion bash"])
+        Then.the_completion_index_is(["available Shirts",
+            "unavailable remote_0"])
+        if maintenance.which('bash'):
+            And.bash_completes("mr_repo get ''", ['remote_0'])
+            And.bash_completes("mr_repo unget ''", ['Shirts'])
+            And.bash_completes("mr_repo rm ''", ['Shirts', 'remote_0'])
+            And.bash_completes("mr_repo sparse ''", ['Shirts', 'remote_0'])
+            And.bash_completes("mr_repo sparse Shirts ''", [])
+            And.bash_completes("mr_repo ge", ['get'])
+
+    def test_get_with_a_sparse_checkout_profile(self):
+        """Getting a repo with a sparse profile only checks out its files
+        and the sparse command reshapes it afterwards."""
+        files = ['docs/index.txt', 'src/main.txt', 'README']
+        Given.I_create_a_Mr_Repo_repository(clean=True)
+        And.I_have_remote_repositories(1)
+        And.I_commit_files_to(world.remotes['remote_0'], files)
+        checkout = os.path.join(world.tdir, 'remote_0')
+        When.I_execute_the_following_input(
+                "sparse remote_0 docs --patterns /docs/ /README")
+        And.I_execute_the_following_input("get remote_0")
+        Then.the_checkout_contains(checkout, ['docs/index.txt', 'README'])
+        When.I_execute_the_following_input("sparse remote_0 full")
+        Then.the_checkout_contains(checkout, files)
+        When.I_execute_the_following_input("sparse remote_0 docs")
+        Then.the_checkout_contains(checkout, ['docs/index.txt', 'README'])
+        When.I_execute_the_following_input("sparse remote_0 nope")
+        Then.the_last_result_matches("^ERROR: .* profile called 'nope'")
+
+    def test_sparse_refuses_dirty_checkouts(self):
+        """The sparse command leaves checkouts with modified files alone
+        unless forced and the full profile cannot be given patterns."""
+        files = ['docs/index.txt', 'src/main.txt']
+        Given.I_create_a_Mr_Repo_repository(clean=True)
+        And.I_have_remote_repositories(1)
+        And.I_commit_files_to(world.remotes['remote_0'], files)
+        checkout = os.path.join(world.tdir, 'remote_0')
+        When.I_execute_the_following_input(["get remote_0",
+            "sparse remote_0 full --patterns /docs/"])
+        Then.the_last_result_matches("^ERROR: The 'full' sparse checkout ")
+        When.I_write_a_file(os.path.join(checkout, 'src', 'main.txt'), 1)
+        And.I_execute_the_following_input(
+                "sparse remote_0 docs --patterns /docs/")
+        Then.the_last_result_matches("^ERROR: 'remote_0' is dirty")
+        And.the_checkout_contains(checkout, files)
+        And.a_refused_sparse_call_leaves_the_config_alone('remote_0')
+        When.I_execute_the_following_input(
+                "sparse remote_0 docs --force --patterns /docs/")
+        Then.the_last_result_matches("^Successfully switched ")
+
+    def test_sparse_reports_missing_checkouts(self):
+        """The sparse command reports available repos whose directory was
+        deleted without defining the profile."""
+        Given.I_have_a_git_repository_called("Sweaters")
+        And.I_create_a_Mr_Repo_repository()
+        shutil.rmtree(world.repos[0].working_dir)
+        When.I_execute_the_following_input(
+                "sparse Sweaters docs --patterns /docs/")
+        Then.the_last_result_matches("^ERROR: 'Sweaters' is missing from ")
+        And.a_refused_sparse_call_leaves_the_config_alone('Sweaters')
+
     # TODO: Add more stories!